@@ -1,8 +1,20 @@
 # 用于快速创建clangd项目描述文件，方便代码阅读
 # 注意未必会与实际匹配
 
-from os import walk, path
-	
+import ctypes
+import json
+import re
+import struct
+from fnmatch import translate as glob
+from hashlib import sha1
+from argparse import ArgumentParser
+from collections import Counter, defaultdict
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from ctypes.util import find_library
+from os import close, cpu_count, fsencode, path, read, scandir, sep, stat
+from select import select
+from time import monotonic
+
 pwd = path.abspath(path.dirname(__file__))
 
 compile_flags_nolibc = """
@@ -14,12 +26,574 @@ arm-none-eabi
 -nostdlib
 """
 
+# 源文件后缀对应的-x语言
+sources = {
+    ".c": "c",
+    ".cc": "c++",
+    ".cpp": "c++",
+    ".cxx": "c++",
+    ".S": "assembler-with-cpp",
+}
+headers = (".h", ".hh", ".hpp", ".hxx")
+
+CACHE = ".mkclangd_cache.json"
+IGNORE_FILES = (".gitignore", ".clangdignore")
+# 所有TU共用的参数放进响应文件，几百个-I不必在每条记录里重复一遍
+RSP = "mkclangd.rsp"
+# 带这些文件的目录算一个独立项目的根(--multi)
+MARKERS = (".mkclangd", "*.uvprojx", "*.cdkproj", "sdkconfig")
+MARKER = re.compile("|".join(glob(marker) for marker in MARKERS))
+
+parser = ArgumentParser()
+parser.add_argument("root", nargs="?", default=pwd, help="source tree (default: where this script is)")
+parser.add_argument("-j", "--jobs", type=int, default=(cpu_count() or 4) * 2, help="scandir threads")
+parser.add_argument("--no-cache", action="store_true", help="ignore the cached directory index")
+parser.add_argument("--all-includes", action="store_true", help="add every header directory instead of resolving #include")
+parser.add_argument("--ignore", action="append", default=[".git/"], metavar="PATTERN",
+                    help="extra gitignore-style pattern for the root (default: .git/)")
+parser.add_argument("--no-ignore", action="store_true", help="walk everything, skip .gitignore/.clangdignore")
+parser.add_argument("-w", "--watch", action="store_true", help="keep running and follow the tree with inotify")
+parser.add_argument("--debounce", type=float, default=0.5, help="seconds of quiet before regenerating (default: 0.5)")
+parser.add_argument("-m", "--multi", action="store_true",
+                    help="one database per project, roots found by marker files (%s)" % ", ".join(MARKERS))
+parser.add_argument("--projects", metavar="FILE", help="project roots relative to root, one per line (implies --multi)")
+
+INCLUDE = re.compile(rb'^[ \t]*#[ \t]*include[ \t]*([<"])([^>"\n]+)[>"]', re.M)
+
+
+def translate(pattern):
+    # gitignore通配符转正则：不带/的匹配任意层的名字，**跨目录，结尾/只匹配目录，\x就是字符x
+    anchored = "/" in pattern.rstrip("/")
+    dironly = pattern.endswith("/")
+    pattern = pattern.strip("/")
+    regex, i = "", 0
+    while i < len(pattern):
+        if pattern.startswith("**/", i):
+            regex += "(?:.*/)?"
+            i += 3
+        elif pattern.startswith("**", i):
+            regex += ".*"
+            i += 2
+        elif pattern[i] == "*":
+            regex += "[^/]*"
+            i += 1
+        elif pattern[i] == "?":
+            regex += "[^/]"
+            i += 1
+        elif pattern[i] == "\\" and i + 1 < len(pattern):
+            regex += re.escape(pattern[i + 1])
+            i += 2
+        elif pattern[i] == "[" and "]" in pattern[i + 2:]:
+            end = pattern.index("]", i + 2)
+            regex += "[" + pattern[i + 1:end].replace("!", "^", 1).replace("\\", "\\\\") + "]"
+            i = end + 1
+        else:
+            regex += re.escape(pattern[i])
+            i += 1
+    return ("" if anchored else "(?:.*/)?") + regex, dironly
+
+
+def combine(rules):
+    # 倒着拼成一个正则，第一个命中的分支就是文件里最后一条命中的规则，lastindex指出是哪条
+    rules = rules[::-1]
+    regex = re.compile("|".join("(%s)\\Z" % regex for regex, _ in rules)) if rules else None
+    return regex, [negated for _, negated in rules]
+
+
+class Rules:
+    # 一个忽略文件的所有规则合成一个正则，按gitignore的规矩最后命中的那条说了算；
+    # 子目录沿着parent链往上查，里层的规则优先
+    def __init__(self, parent, base, patterns):
+        self.parent = parent
+        self.base = base
+        dirs, files = [], []
+        for line in patterns:
+            # 行尾空格要去掉，除非是\转义的
+            line = re.sub(r"(?<!\\)\s+$", "", line)
+            if not line or line.startswith("#"):
+                continue
+            negated = line.startswith("!")
+            regex, dironly = translate(line[1:] if negated else line)
+            dirs.append((regex, negated))
+            if not dironly:
+                files.append((regex, negated))
+        self.dirs, self.files = combine(dirs), combine(files)
+        self.key = sha1(("%s\0%s\0%s" % (parent.key if parent else "", base, "\n".join(patterns))).encode()).hexdigest()
+
+    def ignored(self, file, isdir):
+        rules = self
+        while rules:
+            rel = file[len(rules.base) + 1:].replace(sep, "/")
+            matcher, negated = rules.dirs if isdir else rules.files
+            match = matcher and matcher.match(rel)
+            if match:
+                return not negated[match.lastindex - 1]
+            rules = rules.parent
+        return False
+
+
+def read_rules(dir, names, parent):
+    rules = parent
+    for name in names:
+        try:
+            with open(path.join(dir, name)) as f:
+                rules = Rules(rules, dir, f.read().splitlines())
+        except OSError:
+            pass
+    return rules
+
+
+def scan_dir(dir, cached, parent=None, ignore_files=IGNORE_FILES):
+    # 目录mtime没变说明里面的文件/子目录没有增删，忽略规则也没变就直接用缓存
+    mtime = stat(dir).st_mtime_ns
+    valid = cached and cached["mtime"] == mtime and "markers" in cached
+    if valid:
+        rules = read_rules(dir, cached.get("ignores", ()), parent)
+        if cached.get("rules") == (rules.key if rules else None):
+            return dir, cached, rules
+    with scandir(dir) as it:
+        entries = [(entry.name, entry.is_dir(follow_symlinks=False)) for entry in it]
+    ignores = [name for name, isdir in entries if name in ignore_files and not isdir]
+    # 标记文件在忽略规则之前收集，*.uvprojx之类常被.gitignore掉
+    markers = [name for name, isdir in entries if not isdir and MARKER.match(name)]
+    rules = read_rules(dir, ignores, parent)
+    files, dirs = [], []
+    for name, isdir in entries:
+        # 命中忽略规则的目录在这里就剪掉，不会再往下走
+        if rules and rules.ignored(path.join(dir, name), isdir):
+            continue
+        if isdir:
+            dirs.append(name)
+        elif name.endswith(headers) or path.splitext(name)[1] in sources:
+            files.append(name)
+    entry = {"mtime": mtime, "files": files, "dirs": dirs, "ignores": ignores, "markers": markers,
+             "rules": rules.key if rules else None}
+    return dir, entry, rules
+
+
+def scan(root, jobs, cache=None, rules=None, chains=None, ignore_files=IGNORE_FILES):
+    # 按层并行scandir，返回 {目录: {mtime, files, dirs}}；chains给了就记下每个目录生效的规则
+    cache = cache or {}
+    index = {}
+    level = [(root, rules)]
+    with ThreadPoolExecutor(jobs) as pool:
+        while level:
+            results = pool.map(lambda item: scan_dir(item[0], cache.get(item[0]), item[1], ignore_files), level)
+            level = []
+            for dir, entry, rules in results:
+                index[dir] = entry
+                if chains is not None:
+                    chains[dir] = rules
+                level.extend((path.join(dir, name), rules) for name in entry["dirs"])
+    return index
+
+
+def load_cache(root):
+    # {"dirs": 目录索引, "includes": {文件: [mtime, [[引号, 头文件], ...]]}}
+    try:
+        with open(path.join(root, CACHE)) as f:
+            cache = json.load(f)
+    except (OSError, ValueError):
+        cache = {}
+    return cache if "dirs" in cache else {"dirs": {}, "includes": {}}
+
+
+def save_cache(root, cache):
+    with open(path.join(root, CACHE), "w") as f:
+        json.dump(cache, f)
+
+
+def include_dirs(index):
+    return sorted(dir for dir, entry in index.items() if any(name.endswith(headers) for name in entry["files"]))
+
+
+def parse_includes(file):
+    try:
+        with open(file, "rb") as f:
+            data = f.read()
+    except OSError:
+        return []
+    return [[quote.decode(), name.decode(errors="replace").strip()] for quote, name in INCLUDE.findall(data)]
+
+
+def scan_includes(index, jobs, cache):
+    # 只重新解析mtime变了的文件，解析放进进程池
+    files = [path.join(dir, name) for dir, entry in index.items() for name in entry["files"]]
+    includes, todo = {}, []
+    for file in files:
+        mtime = stat(file).st_mtime_ns
+        cached = cache.get(file)
+        if cached and cached[0] == mtime:
+            includes[file] = cached
+        else:
+            todo.append((file, mtime))
+    if todo:
+        with ProcessPoolExecutor(max(jobs // 2, 1)) as pool:
+            parsed = pool.map(parse_includes, [file for file, _ in todo], chunksize=256)
+            for (file, mtime), names in zip(todo, parsed):
+                includes[file] = [mtime, names]
+    return includes
+
+
+def resolve_includes(index, includes):
+    # 每个#include在候选目录里找，同名头文件取离引用者最近的那个；
+    # 返回按命中次数排序的全部目录、每个源文件按include顺序需要的目录、没找到的头文件
+    by_name = defaultdict(list)
+    for dir, entry in index.items():
+        for name in entry["files"]:
+            by_name[name].append(dir)
+    hits, unresolved, edges = Counter(), Counter(), {}
+    for file, (_, names) in includes.items():
+        here = path.dirname(file)
+        found = edges[file] = []
+        for quote, name in names:
+            subdir, base = path.split(path.normpath(name))
+            if quote == '"':
+                local = path.normpath(path.join(here, subdir))
+                if base in index.get(local, {}).get("files", ()):
+                    # 相对引用者目录就能找到，不用-I，但它自己的include还要跟下去
+                    found.append((None, path.join(local, base)))
+                    continue
+            roots = []
+            for dir in by_name.get(base, ()):
+                if not subdir:
+                    roots.append(dir)
+                elif dir.endswith(sep + subdir):
+                    roots.append(dir[:-len(subdir) - 1])
+            if not roots:
+                unresolved[name] += 1
+                continue
+            dir = max(roots, key=lambda dir: (len(path.commonpath([dir, here])), -len(dir)))
+            hits[dir] += 1
+            found.append((dir, path.join(dir, subdir, base)))
+    paths = {file: search_path(edges, file) for file in edges if path.splitext(file)[1] in sources}
+    return [dir for dir, _ in hits.most_common()], paths, unresolved
+
+
+def search_path(edges, file):
+    # 顺着include链深度优先，按第一次用到的顺序排-I，clang找的时候近的先命中
+    dirs, seen, stack = {}, {file}, [file]
+    while stack:
+        found = edges.get(stack.pop(), ())
+        dirs.update((dir, None) for dir, _ in found if dir)
+        for _, header in reversed(found):
+            if header not in seen:
+                seen.add(header)
+                stack.append(header)
+    return list(dirs)
+
+
+def write_rsp(root, includes):
+    # 响应文件只放目标相关的参数和全部目录，每个文件自己的目录在compile_commands里排在它前面
+    flags = [flag for flag in compile_flags_nolibc.split() if not flag.startswith("-x")]
+    flags.extend("-I%s" % dir for dir in includes)
+    with open(path.join(root, RSP), "w") as f:
+        for flag in flags:
+            f.write('"%s"\n' % flag.replace('"', '\\"'))
+
+
+def compile_commands(root, index, paths):
+    rsp = "@" + path.join(root, RSP)
+    commands = []
+    for dir, entry in sorted(index.items()):
+        for name in sorted(entry["files"]):
+            lang = sources.get(path.splitext(name)[1])
+            if lang:
+                file = path.join(dir, name)
+                own = ["-I%s" % include for include in paths.get(file, ()) if include != dir]
+                commands.append({
+                    "directory": root,
+                    "file": file,
+                    "arguments": ["clang", "-x%s" % lang, "-I%s" % dir, *own, rsp, "-c", file],
+                })
+    return commands
+
+
+def resolve(index, cache, all_includes):
+    if all_includes:
+        return include_dirs(index), {}, Counter()
+    return resolve_includes(index, cache["includes"])
+
+
+def write_commands(root, index, paths):
+    commands = compile_commands(root, index, paths)
+    with open(path.join(root, "compile_commands.json"), "w") as f:
+        json.dump(commands, f)
+    return commands
+
+
+def owner(dir, projects):
+    while dir not in projects:
+        parent = path.dirname(dir)
+        if parent == dir:
+            return None
+        dir = parent
+    return dir
+
+
+def find_projects(root, index, listed=None):
+    # 配置文件列出的优先，否则取带标记文件的目录；项目嵌套时只认最外层
+    if listed:
+        candidates = []
+        for name in listed:
+            dir = path.normpath(path.join(root, name))
+            if dir in index:
+                candidates.append(dir)
+            else:
+                print("no such project: %s" % name)
+    else:
+        candidates = [dir for dir, entry in index.items() if entry["markers"]]
+    projects = set()
+    for dir in sorted(candidates, key=len):
+        if owner(dir, projects) is None:
+            projects.add(dir)
+    return sorted(projects)
+
+
+def build_project(root, own, shared, includes, all_includes):
+    # 候选头文件目录 = 本项目 + 不属于任何项目的公共目录，别的项目的头文件不会混进来
+    found, paths, unresolved = resolve({**shared, **own}, {"includes": includes}, all_includes)
+    write_rsp(root, found)
+    return root, len(found), len(write_commands(root, own, paths)), unresolved
+
+
+def build_projects(root, index, includes, projects, jobs, all_includes=False):
+    owned, roots = defaultdict(dict), set(projects)
+    for dir, entry in index.items():
+        owned[owner(dir, roots)][dir] = entry
+    shared = owned.pop(None, {})
+    targets = [(project, owned.get(project, {})) for project in projects]
+    if any(path.splitext(name)[1] in sources for entry in shared.values() for name in entry["files"]):
+        # 公共目录里自己也有源文件的，在根目录再出一份只含公共部分的
+        targets.append((root, shared))
+    with ProcessPoolExecutor(max(jobs // 2, 1)) as pool:
+        futures = []
+        for project, own in targets:
+            dirs = own.keys() | shared.keys()
+            subset = {file: value for file, value in includes.items() if path.dirname(file) in dirs}
+            futures.append(pool.submit(build_project, project, own, shared, subset, all_includes))
+        return [future.result() for future in futures]
+
+
+IN_CLOSE_WRITE, IN_MOVED_FROM, IN_MOVED_TO, IN_CREATE, IN_DELETE = 0x8, 0x40, 0x80, 0x100, 0x200
+IN_Q_OVERFLOW, IN_IGNORED, IN_ISDIR = 0x4000, 0x8000, 0x40000000
+WATCH_MASK = IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE | IN_DELETE
+
+
+class Watcher:
+    # 内存里维护目录索引，用inotify的增删改名事件增量更新，不做全量扫描
+    def __init__(self, root, index, cache, all_includes=False, debounce=0.5, rules=None, chains=None,
+                 ignore_files=IGNORE_FILES):
+        self.libc = ctypes.CDLL(find_library("c"), use_errno=True)
+        self.fd = self.libc.inotify_init1(0)
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), "inotify_init1 failed")
+        self.root = root
+        self.index = index
+        self.cache = cache
+        self.all_includes = all_includes
+        self.debounce = debounce
+        self.rules = rules
+        self.chains = chains if chains is not None else {}
+        self.ignore_files = ignore_files
+        self.wds = {}
+        for dir in list(index):
+            self.add_watch(dir)
+
+    def add_watch(self, dir):
+        wd = self.libc.inotify_add_watch(self.fd, fsencode(dir), WATCH_MASK)
+        if wd < 0:
+            print("cannot watch %s: errno %d, raise fs.inotify.max_user_watches?" % (dir, ctypes.get_errno()))
+        else:
+            self.wds[wd] = dir
+
+    def events(self, timeout):
+        if not select([self.fd], [], [], timeout)[0]:
+            return []
+        data = read(self.fd, 1 << 16)
+        events, offset = [], 0
+        while offset < len(data):
+            wd, mask, _, size = struct.unpack_from("iIII", data, offset)
+            name = data[offset + 16:offset + 16 + size].rstrip(b"\0").decode(errors="surrogateescape")
+            events.append((wd, mask, name))
+            offset += 16 + size
+        return events
+
+    def parent_rules(self, dir):
+        return self.rules if dir == self.root else self.chains.get(path.dirname(dir))
+
+    def add_tree(self, dir):
+        rules = self.parent_rules(dir)
+        if rules and rules.ignored(dir, True):
+            return
+        # 先挂watch再扫，扫描期间新建的文件也能收到事件
+        self.add_watch(dir)
+        for sub, entry in scan(dir, 4, None, rules, self.chains, self.ignore_files).items():
+            self.index[sub] = entry
+            self.add_watch(sub)
+            for name in entry["files"]:
+                self.update_file(path.join(sub, name))
+        self.touch(path.dirname(dir), path.basename(dir), True)
+
+    def remove_tree(self, dir):
+        for sub in [sub for sub in self.index if sub == dir or sub.startswith(dir + sep)]:
+            for name in self.index.pop(sub)["files"]:
+                self.cache["includes"].pop(path.join(sub, name), None)
+        for sub in [sub for sub in self.chains if sub == dir or sub.startswith(dir + sep)]:
+            del self.chains[sub]
+        for wd in [wd for wd, sub in self.wds.items() if sub == dir or sub.startswith(dir + sep)]:
+            self.libc.inotify_rm_watch(self.fd, wd)
+            del self.wds[wd]
+        self.touch(path.dirname(dir), path.basename(dir), False)
+
+    def touch(self, dir, name, present):
+        # 同步父目录的缓存条目，mtime也更新，下次冷启动缓存仍然有效
+        entry = self.index.get(dir)
+        if entry is None:
+            return
+        key = "dirs" if name in entry["dirs"] or not (name.endswith(headers) or path.splitext(name)[1] in sources) \
+            else "files"
+        if present and name not in entry[key]:
+            entry[key].append(name)
+        elif not present and name in entry[key]:
+            entry[key].remove(name)
+        try:
+            entry["mtime"] = stat(dir).st_mtime_ns
+        except OSError:
+            pass
+
+    def update_file(self, file):
+        try:
+            self.cache["includes"][file] = [stat(file).st_mtime_ns, parse_includes(file)]
+        except OSError:
+            self.cache["includes"].pop(file, None)
+
+    def handle(self, wd, mask, name):
+        dir = self.wds.get(wd)
+        if dir is None or mask & IN_IGNORED:
+            self.wds.pop(wd, None)
+            return
+        target = path.join(dir, name)
+        if name in self.ignore_files and not mask & IN_ISDIR:
+            # 忽略规则变了，这个目录整棵重新扫
+            self.remove_tree(dir)
+            self.add_tree(dir)
+        elif mask & IN_ISDIR:
+            if mask & (IN_CREATE | IN_MOVED_TO):
+                self.add_tree(target)
+            elif mask & (IN_DELETE | IN_MOVED_FROM):
+                self.remove_tree(target)
+        elif name.endswith(headers) or path.splitext(name)[1] in sources:
+            rules = self.chains.get(dir)
+            if rules and rules.ignored(target, False):
+                return
+            if mask & (IN_DELETE | IN_MOVED_FROM):
+                self.touch(dir, name, False)
+                self.cache["includes"].pop(target, None)
+            else:
+                self.touch(dir, name, True)
+                self.update_file(target)
+
+    def rescan(self):
+        # 事件丢了只能按mtime缓存补一遍，没变的目录只stat不scandir；
+        # 新增和mtime变了的文件重新解析include，没了的目录摘掉watch
+        index = scan(self.root, 4, self.index, self.rules, self.chains, self.ignore_files)
+        for dir in set(self.index) - set(index):
+            self.chains.pop(dir, None)
+        for wd in [wd for wd, dir in self.wds.items() if dir not in index]:
+            self.libc.inotify_rm_watch(self.fd, wd)
+            del self.wds[wd]
+        files = {path.join(dir, name) for dir, entry in index.items() for name in entry["files"]}
+        for file in set(self.cache["includes"]) - files:
+            del self.cache["includes"][file]
+        for file in files:
+            cached = self.cache["includes"].get(file)
+            try:
+                if not cached or cached[0] != stat(file).st_mtime_ns:
+                    self.update_file(file)
+            except OSError:
+                self.cache["includes"].pop(file, None)
+        self.index.clear()
+        self.index.update(index)
+        for dir in set(index) - set(self.wds.values()):
+            self.add_watch(dir)
+
+    def run(self, includes, paths, commands):
+        units = {command["file"] for command in commands}
+        while True:
+            events = self.events(None)
+            # 去抖：一直收到没有新事件为止
+            deadline = monotonic() + self.debounce
+            while (timeout := deadline - monotonic()) > 0:
+                more = self.events(timeout)
+                events.extend(more)
+                if more:
+                    deadline = monotonic() + self.debounce
+            if any(mask & IN_Q_OVERFLOW for _, mask, _ in events):
+                self.rescan()
+            else:
+                for wd, mask, name in events:
+                    self.handle(wd, mask, name)
+            changed = []
+            new_includes, new_paths, _ = resolve(self.index, self.cache, self.all_includes)
+            if new_includes != includes:
+                includes = new_includes
+                write_rsp(self.root, includes)
+                changed.append("%d include dirs" % len(includes))
+            new_units = {path.join(dir, name) for dir, entry in self.index.items() for name in entry["files"]
+                         if path.splitext(name)[1] in sources}
+            if new_units != units or new_paths != paths:
+                units, paths = new_units, new_paths
+                changed.append("%d translation units" % len(write_commands(self.root, self.index, paths)))
+            if changed:
+                save_cache(self.root, {"dirs": self.index, "includes": self.cache["includes"]})
+                print("updated: %s" % ", ".join(changed))
+
+    def close(self):
+        close(self.fd)
+
+
 if __name__ == "__main__":
-    includes = set()
-    for root, dirs, files in walk(pwd):
-        if any(map(lambda x: x.endswith(".h"), files)):
-            includes.add(root)
-    with open("compile_flags.txt", "w") as f:
-        f.write(compile_flags_nolibc)
-        for dir in includes:
-            f.write("-I%s\n" % dir)
\ No newline at end of file
+    args = parser.parse_args()
+    multi = args.multi or args.projects
+    if multi and args.watch:
+        parser.error("--watch only follows a single database")
+    root = path.abspath(args.root)
+    cache = {"dirs": {}, "includes": {}} if args.no_cache else load_cache(root)
+    rules = None if args.no_ignore else Rules(None, root, args.ignore)
+    ignore_files = () if args.no_ignore else IGNORE_FILES
+    chains = {}
+    index = scan(root, args.jobs, cache["dirs"], rules, chains, ignore_files)
+    if not args.all_includes:
+        cache["includes"] = scan_includes(index, args.jobs, cache["includes"])
+    if multi:
+        listed = None
+        if args.projects:
+            with open(args.projects) as f:
+                listed = [line.strip() for line in f if line.strip() and not line.startswith("#")]
+        projects = find_projects(root, index, listed)
+        save_cache(root, {"dirs": index, "includes": cache["includes"]})
+        for project, found, units, unresolved in build_projects(root, index, cache["includes"], projects, args.jobs,
+                                                                args.all_includes):
+            print("%s: %d translation units, %d include dirs, %d unresolved" %
+                  (path.relpath(project, root), units, found, sum(unresolved.values())))
+        print("%d projects, %d directories" % (len(projects), len(index)))
+        raise SystemExit
+    includes, paths, unresolved = resolve(index, cache, args.all_includes)
+    if not args.all_includes:
+        for name, count in unresolved.most_common():
+            print("unresolved: %s (%d)" % (name, count))
+        print("%d of %d header directories needed" % (len(includes), len(include_dirs(index))))
+    save_cache(root, {"dirs": index, "includes": cache["includes"]})
+    write_rsp(root, includes)
+    commands = write_commands(root, index, paths)
+    print("%d translation units, %d directories" % (len(commands), len(index)))
+    if args.watch:
+        watcher = Watcher(root, index, cache, args.all_includes, args.debounce, rules, chains, ignore_files)
+        print("watching %d directories" % len(watcher.wds))
+        try:
+            watcher.run(includes, paths, commands)
+        except KeyboardInterrupt:
+            pass
+        finally:
+            watcher.close()
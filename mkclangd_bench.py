@@ -0,0 +1,50 @@
+# mkclangd.py 的遍历测试：生成带大块被忽略目录(out/、.git/、sysroot)的假BSP，
+# 比较不剪枝和按.gitignore剪枝的扫描时间
+
+from argparse import ArgumentParser
+from os import makedirs, path
+from tempfile import TemporaryDirectory
+from time import perf_counter
+
+import mkclangd
+
+parser = ArgumentParser()
+parser.add_argument("-s", "--sources", type=int, default=200, help="source directories (default: 200)")
+parser.add_argument("-i", "--ignored", type=int, default=2000, help="directories under each ignored subtree (default: 2000)")
+parser.add_argument("-j", "--jobs", type=int, default=8, help="scandir threads")
+
+
+def touch(file):
+    open(file, "w").close()
+
+
+def make_tree(root, sources, ignored):
+    for i in range(sources):
+        makedirs(path.join(root, "src", "m%d" % i, "inc"))
+        touch(path.join(root, "src", "m%d" % i, "m%d.c" % i))
+        touch(path.join(root, "src", "m%d" % i, "inc", "m%d.h" % i))
+    for subtree in ("out", ".git", "toolchain/sysroot"):
+        for i in range(ignored):
+            dir = path.join(root, subtree, "d%d" % (i % 50), "d%d" % i)
+            makedirs(dir)
+            touch(path.join(dir, "gen%d.h" % i))
+            touch(path.join(dir, "gen%d.c" % i))
+    with open(path.join(root, ".gitignore"), "w") as f:
+        f.write("out/\n/toolchain/sysroot/\n*.o\n")
+
+
+def bench(root, jobs, rules, ignore_files):
+    start = perf_counter()
+    index = mkclangd.scan(root, jobs, None, rules, None, ignore_files)
+    return perf_counter() - start, index
+
+
+if __name__ == "__main__":
+    args = parser.parse_args()
+    with TemporaryDirectory() as root:
+        make_tree(root, args.sources, args.ignored)
+        full, everything = bench(root, args.jobs, None, ())
+        pruned, index = bench(root, args.jobs, mkclangd.Rules(None, root, [".git/"]), mkclangd.IGNORE_FILES)
+        print("no ignore: %6.3fs %6d dirs %5d header dirs" % (full, len(everything), len(mkclangd.include_dirs(everything))))
+        print("pruned:    %6.3fs %6d dirs %5d header dirs" % (pruned, len(index), len(mkclangd.include_dirs(index))))
+        print("speedup:   %.1fx" % (full / pruned))
@@ -1,30 +1,501 @@
-# pyinstaller -F mygit.py
-import sys
-from os import path
-from subprocess import check_output, Popen,PIPE
-
-# Get the application path with pyinstaller
-if getattr(sys, 'frozen', False):
-    application_path = path.dirname(sys.executable)
-else:
-    application_path = path.dirname(path.abspath(__file__))
-
-git = path.join(application_path, "usr/bin/git.exe")
-cygpath = path.join(application_path, "usr/bin/cygpath.exe")
-
-# Convert Unix paths to Windows paths
-def cygpath_convert(path):
-    return check_output([cygpath, "-w", path]).strip().decode("utf-8")
-
-
-# getpwd() return posix path not a windows path so convert it to windows path
-if __name__ == "__main__":
-    cmd = [git]
-    cmd.extend(sys.argv[1:])
-    p = Popen(cmd, stdout=PIPE)
-    for line in p.stdout:
-        if 'rev-parse' in cmd:
-            print(cygpath_convert(line.decode("utf-8").strip('\n')))
-        else:
-            print(line.decode("utf-8").strip('\n'))
-    
\ No newline at end of file
+# pyinstaller -F mygit.py
+import json
+import re
+import sys
+from functools import lru_cache
+from getpass import getuser
+from multiprocessing.connection import AuthenticationError, Client, Listener
+from os import O_CREAT, O_EXCL, O_WRONLY, chmod, environ, fstat, getcwd, lstat, mkdir, path, remove
+from os import open as os_open
+if sys.platform != "win32":
+    from os import getuid
+from queue import Queue
+from secrets import token_bytes
+from stat import S_ISDIR
+from subprocess import Popen, PIPE
+from tempfile import gettempdir
+from threading import Lock, Thread
+
+# Get the application path with pyinstaller
+if getattr(sys, 'frozen', False):
+    application_path = path.dirname(sys.executable)
+else:
+    application_path = path.dirname(path.abspath(__file__))
+
+git = path.join(application_path, "usr/bin/git.exe")
+
+
+def windows(root):
+    return path.normpath(root).replace("/", "\\")
+
+
+def unescape(field):
+    # fstab里空格写成\040
+    return field.replace("\\040", " ").replace("\\011", "\t").replace("\\134", "\\")
+
+
+@lru_cache(maxsize=None)
+def load_mounts(root, fstab=None, temp=None):
+    # 按msys的规则自己算挂载表，不用起mount.exe：
+    # / 是安装目录，/bin 和 /usr/bin 同一个，再加上etc/fstab里的条目和cygdrive前缀
+    # 返回 (挂载点列表(长的在前), cygdrive前缀)；msys和git for windows都带etc/fstab，
+    # 读不到说明root不是安装目录，返回None让调用方退回cygpath
+    base = windows(root)
+    mounts = {"/": base, "/bin": base + "\\usr\\bin", "/usr/bin": base + "\\usr\\bin", "/usr/lib": base + "\\usr\\lib"}
+    cygdrive = "/"
+    try:
+        with open(fstab or path.join(root, "etc", "fstab")) as f:
+            lines = f.read().splitlines()
+    except OSError:
+        return None
+    for line in lines:
+        fields = line.split("#", 1)[0].split()
+        if len(fields) < 3:
+            continue
+        device, point, kind = unescape(fields[0]), unescape(fields[1]).rstrip("/") or "/", fields[2]
+        if kind == "cygdrive":
+            cygdrive = point
+        elif kind == "usertemp":
+            mounts[point] = windows(temp or environ.get("TEMP", base + "\\tmp"))
+        else:
+            mounts[point] = windows(device)
+    return sorted(mounts.items(), key=lambda item: -len(item[0])), cygdrive
+
+
+class PathTranslator:
+    # POSIX路径转Windows路径，按挂载表纯python转换
+    # 只记目录前缀的结果，文件名直接拼上去，1M个文件也就几万个目录
+    # 挂载表拿不到(mounts=None)时退回一个常驻的 cygpath -w -f - ，一行进一行出
+    # Linux上的测试见mygit_test.py，用假的fstab和假的cygpath
+    def __init__(self, mounts=None, cygpath="cygpath"):
+        self.mounts = mounts
+        self.cygpath = cygpath
+        self.proc = None
+        self.lock = Lock()
+        self.memo = {}
+        self.points = {point for point, _ in mounts[0]} if mounts else set()
+
+    def __call__(self, posix):
+        dir, _, name = posix.rpartition("/")
+        if dir and name and posix not in self.points:
+            prefix = self.lookup(dir)
+            return prefix + name if prefix.endswith("\\") else prefix + "\\" + name
+        return self.lookup(posix)
+
+    def lookup(self, posix):
+        converted = self.memo.get(posix)
+        if converted is None:
+            converted = self.memo[posix] = self.translate(posix) if self.mounts else self.ask(posix)
+        return converted
+
+    def translate(self, posix):
+        if not posix.startswith("/"):
+            return posix.replace("/", "\\")
+        mounts, cygdrive = self.mounts
+        # 显式挂载点优先于cygdrive，cygdrive又优先于根目录
+        for point, target in mounts[:-1]:
+            if posix == point or posix.startswith(point + "/"):
+                return target + posix[len(point):].replace("/", "\\")
+        prefix = cygdrive.rstrip("/") + "/"
+        if posix.startswith(prefix):
+            drive, _, rest = posix[len(prefix):].partition("/")
+            if len(drive) == 1 and drive.isalpha():
+                return drive.upper() + ":\\" + rest.replace("/", "\\")
+        return mounts[-1][1] + posix.replace("/", "\\")
+
+    def ask(self, posix):
+        # 常驻模式下多个请求线程共用一个cygpath
+        with self.lock:
+            if self.proc is None:
+                self.proc = Popen([self.cygpath, "-w", "-f", "-"], stdin=PIPE, stdout=PIPE)
+            self.proc.stdin.write(posix.encode("utf-8") + b"\n")
+            self.proc.stdin.flush()
+            return self.proc.stdout.readline().rstrip(b"\r\n").decode("utf-8")
+
+    def close(self):
+        if self.proc:
+            self.proc.stdin.close()
+            self.proc.wait()
+            self.proc = None
+
+
+def translator(root=application_path):
+    # 挂载表算不出来才用cygpath，优先root里带的，没有就找PATH上的
+    cygpath = path.join(root, "usr", "bin", "cygpath.exe")
+    return PathTranslator(load_mounts(root), cygpath if path.isfile(cygpath) else "cygpath")
+
+
+# 全局选项里带参数的，找子命令时要连参数一起跳过
+VALUE_OPTIONS = {"-C", "-c", "--git-dir", "--work-tree", "--namespace", "--super-prefix", "--config-env"}
+CHUNK = 1 << 16
+WORKTREE = re.compile(r"^(.*\S)( +)([0-9a-f]+ .*|\(bare\).*)$")
+# status --porcelain=v2 每种记录里路径前面有几个字段
+STATUS_FIELDS = {"1": 8, "2": 9, "u": 10, "?": 1, "!": 1}
+
+
+def subcommand(argv):
+    skip = False
+    for i, arg in enumerate(argv):
+        if skip:
+            skip = False
+        elif arg in VALUE_OPTIONS:
+            skip = True
+        elif not arg.startswith("-"):
+            return i
+    return None
+
+
+def options(args):
+    # -sz 这种合写的短选项拆开，--x=y 只留 --x，-- 后面是路径不看
+    opts = set()
+    for arg in args:
+        if arg == "--":
+            break
+        if arg.startswith("--"):
+            opts.add(arg.split("=", 1)[0])
+        elif arg.startswith("-"):
+            opts.update("-" + flag for flag in arg[1:])
+    return opts
+
+
+def ls_files(args, convert):
+    opts = options(args)
+    if "--format" in opts:
+        return None
+    if opts & {"-s", "--stage", "-u", "--unmerged", "--eol"}:
+        # <mode> <object> <stage>\t<path>
+        def record(line):
+            meta, tab, name = line.partition("\t")
+            return meta + tab + convert(name) if tab else line
+        return record
+    if opts & {"-t", "-v"}:
+        return lambda line: line[:2] + convert(line[2:]) if len(line) > 2 else line
+    return convert
+
+
+def diff(args, convert):
+    opts = options(args)
+    if "--name-only" in opts:
+        return convert
+    if "--name-status" not in opts:
+        return None
+    if "-z" not in opts:
+        def record(line):
+            fields = line.split("\t")
+            return "\t".join(fields[:1] + [convert(name) for name in fields[1:]])
+        return record
+    # -z 时状态和路径各占一条：M\0path\0 R100\0old\0new\0
+    remaining = 0
+
+    def record(field):
+        nonlocal remaining
+        if remaining:
+            remaining -= 1
+            return convert(field)
+        remaining = 2 if field[:1] in ("R", "C") else 1
+        return field
+    return record
+
+
+def status(args, convert):
+    version = None
+    for arg in args:
+        if arg == "--":
+            break
+        if arg in ("--porcelain", "--porcelain=v1", "--porcelain=1", "-s", "--short"):
+            version = version or 1
+        elif arg in ("--porcelain=v2", "--porcelain=2"):
+            version = 2
+    opts = options(args)
+    if "-z" in opts:
+        version = version or 1
+    if version is None:
+        return None
+    z = "-z" in opts
+    origin = False
+
+    def v1(field):
+        # XY path / XY orig -> path；-z 时改名的原路径单独一条
+        nonlocal origin
+        if origin:
+            origin = False
+            return convert(field)
+        if field.startswith("## ") or len(field) < 4:
+            return field
+        if z:
+            origin = "R" in field[:2] or "C" in field[:2]
+            return field[:3] + convert(field[3:])
+        old, arrow, new = field[3:].partition(" -> ")
+        return field[:3] + (convert(old) + arrow + convert(new) if arrow else convert(old))
+
+    def v2(field):
+        nonlocal origin
+        if origin:
+            origin = False
+            return convert(field)
+        count = STATUS_FIELDS.get(field[:1])
+        fields = field.split(" ", count) if count else ()
+        if len(fields) <= (count or 0):
+            return field
+        name = fields[count]
+        if field[:1] != "2":
+            fields[count] = convert(name)
+        elif z:
+            origin = True
+            fields[count] = convert(name)
+        else:
+            new, tab, old = name.partition("\t")
+            fields[count] = convert(new) + tab + convert(old)
+        return " ".join(fields)
+    return v1 if version == 1 else v2
+
+
+def worktree(args, convert):
+    if not args or args[0] != "list":
+        return None
+    if "--porcelain" in options(args):
+        return lambda line: "worktree " + convert(line[9:]) if line.startswith("worktree ") else line
+
+    def record(line):
+        # <path>  <commit> [branch]，路径可能带空格
+        match = WORKTREE.match(line)
+        return convert(match[1]) + match[2] + match[3] if match else line
+    return record
+
+
+# 子命令 -> 给定参数时每条输出记录的转换函数，返回None的直接透传
+FORMATS = {
+    "rev-parse": lambda args, convert: convert,
+    "ls-files": ls_files,
+    "status": status,
+    "diff": diff,
+    "diff-files": diff,
+    "diff-index": diff,
+    "diff-tree": diff,
+    "worktree": worktree,
+}
+
+
+def rewrite(stream, out, convert, sep=b"\n"):
+    # 按块读，只有转换的时候才按记录切，最后不完整的一条留到下一块
+    pending = b""
+    while chunk := stream.read1(CHUNK):
+        records = (pending + chunk).split(sep)
+        pending = records.pop()
+        out.write(b"".join(convert(record.decode("utf-8", "surrogateescape")).encode("utf-8", "surrogateescape")
+                           + sep for record in records))
+    if pending:
+        out.write(convert(pending.decode("utf-8", "surrogateescape")).encode("utf-8", "surrogateescape"))
+    out.flush()
+
+
+def copy(stream, out):
+    while chunk := stream.read1(CHUNK):
+        out.write(chunk)
+        out.flush()
+
+
+def feed(chunks, stdin):
+    try:
+        for chunk in chunks:
+            stdin.write(chunk)
+            stdin.flush()
+        stdin.close()
+    except OSError:
+        # git不读stdin就退出了
+        pass
+
+
+def run(argv, git=git, convert=None, stdout=None, stderr=None, stdin=None, cwd=None, env=None):
+    # stdout/stderr给了文件对象就往里写，stdin给了就是bytes块的迭代器，常驻模式用
+    index = subcommand(argv)
+    format = FORMATS.get(argv[index]) if index is not None else None
+    args = argv[index + 1:] if index is not None else []
+    record = format(args, convert or translator()) if format else None
+    # 不转换的命令stdout/stderr都直接继承，git自己写控制台，一个字节都不经过这里
+    if record is None and stdout is None:
+        return Popen([git] + argv, cwd=cwd, env=env).wait()
+    p = Popen([git] + argv, stdout=PIPE, stderr=PIPE if stderr else None, stdin=PIPE if stdin else None,
+              cwd=cwd, env=env)
+    threads = []
+    if stderr:
+        threads.append(Thread(target=copy, args=(p.stderr, stderr), daemon=True))
+    if stdin:
+        threads.append(Thread(target=feed, args=(stdin, p.stdin), daemon=True))
+    for thread in threads:
+        thread.start()
+    try:
+        if record:
+            rewrite(p.stdout, stdout or sys.stdout.buffer, record, b"\0" if "-z" in options(args) else b"\n")
+        else:
+            copy(p.stdout, stdout)
+    finally:
+        p.stdout.close()
+    code = p.wait()
+    if stderr:
+        threads[0].join()
+    return code
+
+
+# 常驻模式：mygit --serve 常驻后台，之后stdout不是控制台(IDE调用)的请求转给它，
+# 省掉onefile解包和python启动。连接两头都用家目录里只有自己能读的密钥做authkey握手，
+# 抢先占了地址的别人过不了握手；消息不用pickle：请求是JSON，之后每帧第一个字节是fd，
+# 0是stdin，1/2是输出，EXIT后面跟退出码
+EXIT = 255
+KEY = path.join(path.expanduser("~"), ".mygit-key")
+
+
+def runtime_dir():
+    # socket放在只有自己能进的目录里，优先XDG_RUNTIME_DIR
+    dir = environ.get("XDG_RUNTIME_DIR") or path.join(gettempdir(), "mygit-%d" % getuid())
+    try:
+        mkdir(dir, 0o700)
+    except FileExistsError:
+        pass
+    info = lstat(dir)
+    if not S_ISDIR(info.st_mode) or info.st_uid != getuid() or info.st_mode & 0o077:
+        raise SystemExit("mygit: %s is not a private directory" % dir)
+    return dir
+
+
+def secret(key=KEY):
+    # 第一次用时生成，0600；别人能读或者不是自己的就不用
+    try:
+        fd = os_open(key, O_WRONLY | O_CREAT | O_EXCL, 0o600)
+        with open(fd, "wb") as f:
+            f.write(token_bytes(32))
+    except FileExistsError:
+        pass
+    with open(key, "rb") as f:
+        if sys.platform != "win32":
+            info = fstat(f.fileno())
+            if info.st_uid != getuid() or info.st_mode & 0o077:
+                raise SystemExit("mygit: %s must be private to you (chmod 600)" % key)
+        return f.read()
+
+
+def default_address():
+    if "MYGIT_SERVER" in environ:
+        return environ["MYGIT_SERVER"]
+    if sys.platform == "win32":
+        return r"\\.\pipe\mygit-" + getuser()
+    return path.join(runtime_dir(), "mygit.sock")
+
+
+def owned(address):
+    # 地址不存在(没人--serve)就不碰密钥文件；unix socket还要确认是自己的，命名管道靠authkey握手
+    if sys.platform == "win32":
+        return path.exists(address)
+    try:
+        return lstat(address).st_uid == getuid()
+    except OSError:
+        return False
+
+
+class Channel:
+    # 把写文件变成往连接上发帧，stdout/stderr两个线程共用一把锁
+    def __init__(self, conn, fd, lock):
+        self.conn = conn
+        self.fd = fd
+        self.lock = lock
+
+    def write(self, data):
+        with self.lock:
+            self.conn.send_bytes(bytes([self.fd]) + data)
+
+    def flush(self):
+        pass
+
+
+def receive(conn, chunks):
+    # 客户端的stdin块放进队列，空块是EOF；之后一直收到客户端断开再关连接
+    try:
+        while True:
+            frame = conn.recv_bytes()
+            if frame[0] == 0:
+                chunks.put(frame[1:] or None)
+    except (EOFError, OSError, IndexError):
+        chunks.put(None)
+    conn.close()
+
+
+def handle(conn, git, convert):
+    try:
+        request = json.loads(conn.recv_bytes())
+        argv, cwd, env = request["argv"], request["cwd"], request["env"]
+    except (EOFError, OSError, ValueError, KeyError, TypeError):
+        conn.close()
+        return
+    chunks, lock = Queue(), Lock()
+    Thread(target=receive, args=(conn, chunks), daemon=True).start()
+    try:
+        code = run(argv, git, convert, Channel(conn, 1, lock), Channel(conn, 2, lock), iter(chunks.get, None),
+                   cwd, env)
+    except (OSError, TypeError, ValueError) as e:
+        Channel(conn, 2, lock).write(("mygit: %s\n" % e).encode())
+        code = 1
+    with lock:
+        conn.send_bytes(bytes([EXIT]) + str(code).encode())
+
+
+def serve(address=None, git=git, convert=None, key=KEY):
+    address = address or default_address()
+    authkey = secret(key)
+    if sys.platform != "win32" and path.exists(address):
+        # 上次没退干净留下的socket文件
+        try:
+            Client(address, authkey=authkey).close()
+            raise SystemExit("mygit server already running on %s" % address)
+        except ConnectionRefusedError:
+            remove(address)
+    convert = convert or translator()
+    with Listener(address, authkey=authkey) as listener:
+        if sys.platform != "win32":
+            chmod(address, 0o600)
+        while True:
+            try:
+                conn = listener.accept()
+            except (AuthenticationError, OSError, EOFError):
+                continue
+            Thread(target=handle, args=(conn, git, convert), daemon=True).start()
+
+
+def remote(argv, address=None, stdin=None, stdout=None, stderr=None, key=KEY):
+    # 连不上、不是自己的、握手不过都返回None，调用方自己跑；stdin/stdout/stderr都是二进制流
+    try:
+        address = address or default_address()
+        if not owned(address):
+            return None
+        conn = Client(address, authkey=secret(key))
+    except (OSError, EOFError, AuthenticationError, SystemExit):
+        return None
+    stdin = stdin or sys.stdin.buffer
+    outputs = {1: stdout or sys.stdout.buffer, 2: stderr or sys.stderr.buffer}
+    conn.send_bytes(json.dumps({"argv": argv, "cwd": getcwd(), "env": dict(environ)}).encode())
+
+    def forward():
+        try:
+            while chunk := stdin.read1(CHUNK):
+                conn.send_bytes(b"\0" + chunk)
+            conn.send_bytes(b"\0")
+        except (OSError, ValueError):
+            pass
+    Thread(target=forward, daemon=True).start()
+    with conn:
+        while True:
+            frame = conn.recv_bytes()
+            if frame[0] == EXIT:
+                return int(frame[1:])
+            outputs[frame[0]].write(frame[1:])
+            outputs[frame[0]].flush()
+
+
+# getpwd() return posix path not a windows path so convert it to windows path
+if __name__ == "__main__":
+    if sys.argv[1:] == ["--serve"]:
+        serve()
+    code = None
+    # 控制台上交互用的还是本地跑，分页、颜色、编辑器都照旧
+    if not sys.stdout.isatty() and sys.stdin and not sys.stdin.isatty():
+        code = remote(sys.argv[1:])
+    sys.exit(run(sys.argv[1:]) if code is None else code)
@@ -0,0 +1,115 @@
+# mygit.py 的输出测试：造一个 git log -p 有几十MB的临时仓库，
+# 比较原来逐行decode再print 和 现在直接透传/按块转换 的吞吐，以及输出是否和git一致
+# 再比较每次调用本地起git 和 经常驻server转发 的延迟
+# python mygit_bench.py -c 200 -s 256 -n 200
+import io
+import sys
+from argparse import ArgumentParser
+from os import getpid, path, urandom
+from subprocess import DEVNULL, PIPE, Popen, check_call
+from tempfile import TemporaryDirectory, gettempdir
+from threading import Thread
+from time import perf_counter, sleep
+
+import mygit
+
+parser = ArgumentParser()
+parser.add_argument("-c", "--commits", type=int, default=200, help="commits in the test repo (default: 200)")
+parser.add_argument("-s", "--size", type=int, default=256, help="KiB of text changed per commit (default: 256)")
+parser.add_argument("-g", "--git", default="git", help="git to run")
+parser.add_argument("-n", "--calls", type=int, default=200, help="rev-parse calls for the latency test (default: 200)")
+
+here = path.dirname(path.abspath(__file__))
+
+# 改之前mygit.py的主循环
+legacy = """
+import sys
+from subprocess import Popen, PIPE
+cmd = [sys.argv[1]] + sys.argv[2:]
+p = Popen(cmd, stdout=PIPE)
+for line in p.stdout:
+    print(line.decode("utf-8").strip('\\n'))
+"""
+
+current = """
+import sys
+sys.path.insert(0, %r)
+import mygit
+sys.exit(mygit.run(sys.argv[2:], sys.argv[1]))
+""" % here
+
+rewriter = """
+import sys
+sys.path.insert(0, %r)
+import mygit
+# 把log当成要转换的命令，转换函数原样返回，测的是按块切行本身的开销
+mygit.FORMATS["log"] = lambda args, convert: convert
+sys.exit(mygit.run(sys.argv[2:], sys.argv[1], lambda line: line))
+""" % here
+
+# 和下面常驻server一样不做路径转换(cygpath只在windows上有)，两边只差进程启动
+identity = """
+import sys
+sys.path.insert(0, %r)
+import mygit
+sys.exit(mygit.run(sys.argv[2:], sys.argv[1], lambda name: name))
+""" % here
+
+
+def make_repo(repo, git, commits, size):
+    check_call([git, "init", "-q", repo])
+    for i in range(commits):
+        with open(path.join(repo, "file%d.txt" % (i % 10)), "w") as f:
+            f.write("\n".join(urandom(24).hex() for _ in range(size * 1024 // 49)))
+        check_call([git, "-C", repo, "add", "-A"])
+        check_call([git, "-C", repo, "-c", "user.name=bench", "-c", "user.email=bench@localhost",
+                    "commit", "-q", "-m", "commit %d" % i])
+
+
+def timeit(argv):
+    start = perf_counter()
+    p = Popen(argv, stdout=PIPE, stderr=DEVNULL)
+    data = p.stdout.read()
+    p.wait()
+    return perf_counter() - start, data
+
+
+if __name__ == "__main__":
+    args = parser.parse_args()
+    with TemporaryDirectory() as repo:
+        make_repo(repo, args.git, args.commits, args.size)
+        command = [args.git, "-C", repo, "log", "-p"]
+        cost, expected = timeit(command)
+        print("git log -p: %.1f MB" % (len(expected) / 1e6))
+        print("git itself:  %6.3fs %8.1f MB/s" % (cost, len(expected) / 1e6 / cost))
+        for name, script in (("legacy", legacy), ("passthrough", current), ("rewriter", rewriter)):
+            cost, data = timeit([sys.executable, "-c", script] + command)
+            print("%-12s %6.3fs %8.1f MB/s %s" % (name + ":", cost, len(expected) / 1e6 / cost,
+                                                  "same" if data == expected else "DIFFERENT"))
+
+        # 常驻server跑在本进程的线程里，客户端在本进程里调remote()，测的是一次转发的往返；
+        # 对比的是每次都起一个python跑mygit.run，两边都检查退出码和输出是否和git一致
+        key = path.join(repo, ".git", "mygit-key")
+        address = path.join(gettempdir(), "mygit-bench-%d.sock" % getpid())
+        Thread(target=mygit.serve, args=(address, args.git, lambda name: name, key), daemon=True).start()
+        while not path.exists(address):
+            sleep(0.01)
+        argv = ["-C", repo, "rev-parse", "--show-toplevel"]
+        expected = Popen([args.git] + argv, stdout=PIPE).communicate()[0]
+
+        def process():
+            p = Popen([sys.executable, "-c", identity, args.git] + argv, stdout=PIPE, stderr=DEVNULL)
+            return p.communicate()[0], p.returncode
+
+        def resident():
+            out = io.BytesIO()
+            code = mygit.remote(argv, address, io.BytesIO(), out, io.BytesIO(), key)
+            return out.getvalue(), code
+
+        for name, call in (("process", process), ("resident", resident)):
+            start = perf_counter()
+            for _ in range(args.calls):
+                data, code = call()
+                if code != 0 or data != expected:
+                    raise SystemExit("%s: exit %s, output %r" % (name, code, data))
+            print("%-12s %6.2f ms/call" % (name + ":", (perf_counter() - start) * 1000 / args.calls))
@@ -0,0 +1,99 @@
+# mygit.py 路径转换在Linux上的测试：假的msys安装目录(etc/fstab)和假的cygpath
+# python -m unittest mygit_test
+import unittest
+from os import chmod, environ, makedirs, path, pathsep
+from tempfile import TemporaryDirectory
+
+import mygit
+
+FSTAB = """# comment
+none / cygdrive binary,posix=0,noacl,user 0 0
+none /tmp usertemp binary,posix=0,noacl 0 0
+D:/src /src ntfs binary 0 0
+D:/My\\040Work /work ntfs binary 0 0
+"""
+
+# 一行进一行出，和 cygpath -w -f - 一样
+CYGPATH = """#!/bin/sh
+while read -r line; do echo "W:$line"; done
+"""
+
+
+def fake_cygpath(file):
+    makedirs(path.dirname(file), exist_ok=True)
+    with open(file, "w") as f:
+        f.write(CYGPATH)
+    chmod(file, 0o755)
+
+
+class MountTableTest(unittest.TestCase):
+    def setUp(self):
+        self.tmp = TemporaryDirectory()
+        self.root = path.join(self.tmp.name, "git")
+        makedirs(path.join(self.root, "etc"))
+        with open(path.join(self.root, "etc", "fstab"), "w") as f:
+            f.write(FSTAB)
+        self.base = mygit.windows(self.root)
+        self.convert = mygit.PathTranslator(mygit.load_mounts(self.root, temp="C:/Temp"))
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def test_install_dir(self):
+        self.assertEqual(self.convert("/usr/bin/git"), self.base + "\\usr\\bin\\git")
+        self.assertEqual(self.convert("/bin/sh"), self.base + "\\usr\\bin\\sh")
+        self.assertEqual(self.convert("/etc"), self.base + "\\etc")
+        self.assertEqual(self.convert("/"), self.base + "\\")
+
+    def test_cygdrive(self):
+        self.assertEqual(self.convert("/c/Users/me/repo"), "C:\\Users\\me\\repo")
+        self.assertEqual(self.convert("/d"), "D:\\")
+
+    def test_fstab_entries(self):
+        self.assertEqual(self.convert("/src/a.c"), "D:\\src\\a.c")
+        self.assertEqual(self.convert("/work/x"), "D:\\My Work\\x")
+        self.assertEqual(self.convert("/tmp/f"), "C:\\Temp\\f")
+
+    def test_relative(self):
+        self.assertEqual(self.convert("a/b/c"), "a\\b\\c")
+
+    def test_translator_uses_table(self):
+        self.assertIsNotNone(mygit.translator(self.root).mounts)
+
+
+class CygpathFallbackTest(unittest.TestCase):
+    def setUp(self):
+        self.tmp = TemporaryDirectory()
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def run_translator(self, convert):
+        try:
+            return [convert("/c/x/a.c"), convert("/c/x/b.c"), convert("/home")]
+        finally:
+            convert.close()
+
+    def test_bundled_cygpath(self):
+        # 没有etc/fstab，用root/usr/bin里的cygpath
+        root = path.join(self.tmp.name, "app")
+        fake_cygpath(path.join(root, "usr", "bin", "cygpath.exe"))
+        convert = mygit.translator(root)
+        self.assertIsNone(convert.mounts)
+        self.assertEqual(self.run_translator(convert), ["W:/c/x\\a.c", "W:/c/x\\b.c", "W:/home"])
+
+    def test_cygpath_on_path(self):
+        # root里什么都没有，用PATH上的cygpath
+        bin = path.join(self.tmp.name, "bin")
+        fake_cygpath(path.join(bin, "cygpath"))
+        saved = environ["PATH"]
+        environ["PATH"] = bin + pathsep + saved
+        try:
+            convert = mygit.translator(path.join(self.tmp.name, "missing"))
+            self.assertEqual(self.run_translator(convert), ["W:/c/x\\a.c", "W:/c/x\\b.c", "W:/home"])
+        finally:
+            environ["PATH"] = saved
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -7,26 +7,358 @@
 # p：enable the pr_debug() callsite；
 # f/l/m/t：include the function name、line number、module name、threadID in the printed message；
 
+import struct
 from subprocess import check_call
 from argparse import ArgumentParser
-from os import path
-from shutil import copyfileobj
+from collections import Counter, defaultdict
+from functools import reduce
+from math import gcd
+from mmap import mmap, ACCESS_READ
+from os import fstat, path, remove
+from stat import S_ISREG
+from time import perf_counter
+from zlib import crc32
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
 
 parser = ArgumentParser()
-parser.add_argument('-b', '--block', type=int, default=64)
-parser.add_argument('-p', '--page', type=int, default=2048)
+parser.add_argument('-b', '--block', type=int, help='pages per erase block (default: from the UBI headers, else 64)')
+parser.add_argument('-p', '--page', type=int, help='page size (default: from the UBI headers, else 2048)')
+parser.add_argument('-o', '--output', help='write here instead of reloading nandsim and writing /dev/mtd0')
+parser.add_argument('-i', '--inspect', action='store_true', help='scan the UBI headers in the image, no nandsim')
+parser.add_argument('--map', action='store_true', help='with --inspect, also print every LEB -> PEB')
 parser.add_argument('nandfile', type=str, help='nand image file')
 
+# 页标记：DIRTY要写，ERASED全0xFF跳过，PATCHED页里有一段在.erased记录里，要补0xFF再写
+DIRTY, ERASED, PATCHED = 0, 1, 2
+WINDOW = 64 << 20
+
+
+def load_erased(image):
+    # remotedd -e 拉下来的镜像，0xFF的区间在文件里是洞，记在旁边的 .erased 里
+    if not path.exists(image + '.erased'):
+        return []
+    with open(image + '.erased') as f:
+        return [tuple(int(x, 16) for x in line.split()) for line in f if line.strip()]
+
+
+def save_erased(image, runs):
+    if not runs:
+        if path.exists(image + '.erased'):
+            remove(image + '.erased')
+        return
+    with open(image + '.erased', 'w') as f:
+        for offset, length in runs:
+            f.write(f'{offset:#x} {length:#x}\n')
+
+
+def page_map(data, page, size, runs=()):
+    # 每页一个字节的标记；有numpy按64MB窗口整页比较，没有就逐页和全0xFF比
+    pages = size // page
+    if np is not None:
+        marks = np.zeros(pages, dtype=np.uint8)
+        step = max(WINDOW // page, 1)
+        for first in range(0, pages, step):
+            count = min(step, pages - first)
+            words = np.frombuffer(data, dtype=np.uint64, count=count * page // 8, offset=first * page)
+            marks[first:first + count] = (words.reshape(count, -1) == np.uint64(0xffffffffffffffff)).all(axis=1)
+            del words
+        marks = bytearray(marks.tobytes())
+    else:
+        blank = b'\xff' * page
+        marks = bytearray(data[offset:offset + page] == blank for offset in range(0, pages * page, page))
+    patches = {}
+    for offset, length in runs:
+        end = min(offset + length, pages * page)
+        first, last = -(-offset // page), end // page
+        if first < last:
+            marks[first:last] = bytes([ERASED]) * (last - first)
+        # 两头不满一页的部分：文件里是0，补成0xFF再看
+        for index in {offset // page, end // page}:
+            lo, hi = max(offset, index * page) - index * page, min(end, index * page + page) - index * page
+            if first <= index < last or index >= pages or hi <= lo:
+                continue
+            chunk = patches.get(index) or bytearray(data[index * page:index * page + page])
+            chunk[lo:hi] = b'\xff' * (hi - lo)
+            patches[index] = chunk
+    for index, chunk in patches.items():
+        marks[index] = ERASED if chunk.count(0xff) == page else PATCHED
+    return marks, patches
+
+
+def erased_runs(marks, page):
+    runs, index = [], marks.find(ERASED)
+    while index != -1:
+        stop = marks.find(DIRTY, index)
+        patched = marks.find(PATCHED, index)
+        stop = min(x for x in (stop, patched, len(marks)) if x != -1)
+        runs.append((index * page, (stop - index) * page))
+        index = marks.find(ERASED, stop)
+    return runs
+
+
+def load(image, target, erase, page):
+    # 镜像mmap进来，按擦除块对齐写，切片是memoryview不复制；不满一块的尾巴写不进分区，丢掉
+    # nandsim加载后全是擦除状态，整块/整页0xFF的不写，写了反而会把ECC也编程进去
+    with open(image, 'rb') as raw, mmap(raw.fileno(), 0, access=ACCESS_READ) as data, \
+            open(target, 'wb', buffering=0) as mtd:
+        blocks, tail = divmod(len(data), erase)
+        size, per = blocks * erase, erase // page
+        start = perf_counter()
+        marks, patches = page_map(data, page, size, load_erased(image))
+        view = memoryview(data)
+        skipped = written = position = 0
+        for first in range(0, blocks * per, per):
+            end = first + per
+            if marks.count(ERASED, first, end) == per:
+                skipped += 1
+                continue
+            index = first
+            while index < end:
+                if marks[index] == ERASED:
+                    index += 1
+                    continue
+                if marks[index] == PATCHED:
+                    stop = index + 1
+                else:
+                    stop = min(x for x in (marks.find(ERASED, index, end), marks.find(PATCHED, index, end), end)
+                               if x != -1)
+                if position != index * page:
+                    mtd.seek(index * page)
+                mtd.write(patches[index] if marks[index] == PATCHED else view[index * page:stop * page])
+                written += (stop - index) * page
+                position, index = stop * page, stop
+        if S_ISREG(fstat(mtd.fileno()).st_mode):
+            # 普通文件跳过的地方是洞，和remotedd一样记进 .erased
+            mtd.truncate(size)
+            save_erased(target, erased_runs(marks, page))
+        cost = perf_counter() - start
+        view.release()
+    return blocks, skipped, written, tail, cost
+
+
+# UBI的头都是大端64字节，最后4字节是前面60字节的crc32(不取反)
+UBI_EC_MAGIC, UBI_VID_MAGIC = b'UBI#', b'UBI!'
+EC_HDR = struct.Struct('>4sB3xQIII32xI')  # magic version ec vid_hdr_offset data_offset image_seq crc
+VID_HDR = struct.Struct('>4sBBBBII4xIIII4xQ12xI')  # magic version vol_type copy_flag compat vol_id lnum
+                                                   # data_size used_ebs data_pad data_crc sqnum crc
+VTBL_RECORD = struct.Struct('>IIIBBH128sB23xI')  # reserved_pebs alignment data_pad vol_type upd_marker
+                                                 # name_len name flags crc
+UBI_LAYOUT_VOLUME_ID = 0x7fffefff
+UBI_MAX_VOLUMES = 128
+VOL_TYPES = {1: 'dynamic', 2: 'static'}
+
+
+def ubi_crc(data):
+    return crc32(data) ^ 0xffffffff
+
+
+def magic_at(data, peb, count, offset, magic):
+    # 每个PEB同一位置的4字节，numpy按PEB做步长直接看成一列大端整数，一次比完
+    if np is not None:
+        words = np.ndarray((count,), dtype='>u4', buffer=data, offset=offset, strides=(peb,))
+        hits = np.flatnonzero(words == int.from_bytes(magic, 'big')).tolist()
+        del words
+        return hits
+    return [index for index in range(count) if data[index * peb + offset:index * peb + offset + 4] == magic]
+
+
+def scan_ubi(data, peb):
+    # 返回 {peb: (状态, ec头, vid头)}，状态是 used/free/empty/corrupt
+    count = len(data) // peb
+    result = {}
+    for index in magic_at(data, peb, count, 0, UBI_EC_MAGIC):
+        offset = index * peb
+        ec = EC_HDR.unpack_from(data, offset)
+        if ubi_crc(data[offset:offset + EC_HDR.size - 4]) != ec[-1] or ec[3] + VID_HDR.size > peb:
+            result[index] = ('corrupt', None, None)
+            continue
+        vid_offset = offset + ec[3]
+        if data[vid_offset:vid_offset + 4] != UBI_VID_MAGIC:
+            # 只有EC头：擦过、等着被用的PEB
+            result[index] = ('free', ec, None)
+            continue
+        vid = VID_HDR.unpack_from(data, vid_offset)
+        good = ubi_crc(data[vid_offset:vid_offset + VID_HDR.size - 4]) == vid[-1]
+        result[index] = ('used', ec, vid) if good else ('corrupt', ec, None)
+    # 没有EC头的整块和全0xFF比，一次memcmp
+    blank = b'\xff' * peb
+    for index in range(count):
+        if index not in result:
+            result[index] = ('empty' if data[index * peb:index * peb + peb] == blank else 'corrupt', None, None)
+    return result
+
+
+def leb_map(pebs):
+    # 同一个LEB有多份时(磨损均衡搬运中掉电)，和UBI一样取sqnum大的
+    volumes = defaultdict(dict)
+    for index, (state, _, vid) in pebs.items():
+        if state != 'used':
+            continue
+        vol_id, lnum, sqnum = vid[5], vid[6], vid[11]
+        current = volumes[vol_id].get(lnum)
+        if current is None or pebs[current][2][11] < sqnum:
+            volumes[vol_id][lnum] = index
+    return volumes
+
+
+def volume_table(data, peb, pebs, volumes):
+    layout = volumes.get(UBI_LAYOUT_VOLUME_ID, {})
+    if 0 not in layout:
+        return {}
+    index = layout[0]
+    ec = pebs[index][1]
+    if ec[4] >= peb:
+        return {}
+    offset = index * peb + ec[4]
+    table = {}
+    for vol_id in range(min(UBI_MAX_VOLUMES, (peb - ec[4]) // VTBL_RECORD.size)):
+        record = data[offset + vol_id * VTBL_RECORD.size:offset + (vol_id + 1) * VTBL_RECORD.size]
+        fields = VTBL_RECORD.unpack(record)
+        if fields[0] and ubi_crc(record[:-4]) == fields[-1]:
+            table[vol_id] = fields
+    return table
+
+
+# 文件开头注释里那几种：id_bytes, 容量, PEB, 页, 子页
+GEOMETRIES = [
+    ('0x20,0x33,0x00,0x00', 16 << 20, 16 << 10, 512, 512),
+    ('0xec,0xa1,0x00,0x15', 128 << 20, 128 << 10, 2048, 512),
+    ('0x20,0xa5,0x00,0x15', 2 << 30, 128 << 10, 2048, 512),
+    ('0x20,0xa5,0x00,0x26', 4 << 30, 256 << 10, 4096, 1024),
+    ('0x20,0xa7,0x00,0x15', 4 << 30, 256 << 10, 4096, 2048),
+]
+DEFAULT_GEOMETRY = GEOMETRIES[1]
+MIN_PEB = 16 << 10
+
+
+def detect_ubi(data):
+    # 按最小的PEB步长找EC头，校验过的头所在偏移取最大公约数就是PEB大小
+    # 返回 (PEB, VID头偏移, 数据偏移)，头太少判断不了返回None
+    headers = []
+    for index in magic_at(data, MIN_PEB, len(data) // MIN_PEB, 0, UBI_EC_MAGIC):
+        offset = index * MIN_PEB
+        ec = EC_HDR.unpack_from(data, offset)
+        if ubi_crc(data[offset:offset + EC_HDR.size - 4]) == ec[-1]:
+            headers.append((offset, ec[3], ec[4]))
+    peb = reduce(gcd, (offset for offset, _, _ in headers), 0)
+    if not peb:
+        return None
+    (vid_offset, data_offset), _ = Counter((vid, data) for _, vid, data in headers).most_common(1)[0]
+    return peb, vid_offset, data_offset
+
+
+def pick_geometry(peb, vid_offset, data_offset, size):
+    # UBI的数据偏移是VID头后面按页对齐，所以有两种读法：
+    # VID头在子页上、数据从下一页开始(页=数据偏移)；或者没有子页、VID头独占一页(页=VID头偏移)
+    layouts = []
+    if vid_offset + VID_HDR.size <= data_offset and data_offset % vid_offset == 0:
+        layouts.append((data_offset, vid_offset))
+    if data_offset == -(-(vid_offset + VID_HDR.size) // vid_offset) * vid_offset:
+        layouts.append((vid_offset, vid_offset))
+    matches = [entry for entry in GEOMETRIES if entry[2] == peb and entry[3:] in layouts]
+    if not matches:
+        # 子页对不上(ubinize -O 指定过VID头偏移)，页大小对上就行，attach时带 -O
+        matches = [entry for entry in GEOMETRIES if entry[2] == peb
+                   and entry[3] in [page for page, _ in layouts]]
+    if not matches:
+        return None
+    # 装得下的里面挑最小的芯片，都装不下就挑最大的，再用overridesize撑大
+    fits = [entry for entry in matches if entry[1] >= size]
+    return min(fits, key=lambda entry: entry[1]) if fits else max(matches, key=lambda entry: entry[1])
+
+
+def geometry(image, block=None, page=None):
+    # 返回 (GEOMETRIES里的一项, 擦除块大小, 页大小, VID头偏移)；给了-b/-p就不探测
+    if block is None and page is None and path.getsize(image):
+        with open(image, 'rb') as raw, mmap(raw.fileno(), 0, access=ACCESS_READ) as data:
+            found = detect_ubi(data)
+            size = len(data)
+        if found:
+            peb, vid_offset, data_offset = found
+            chosen = pick_geometry(peb, vid_offset, data_offset, size)
+            print(f'UBI headers: PEB {peb // 1024} KiB, VID header offset {vid_offset}, data offset {data_offset}')
+            if chosen:
+                print(f'geometry: id_bytes={chosen[0]} ({chosen[1] >> 20} MiB, page {chosen[3]}, '
+                      f'sub-page {chosen[4]})')
+                return chosen, peb, chosen[3], vid_offset
+            # 表里没有对应的芯片，nandsim只能用默认的，但扫描/写入还是按探测到的PEB
+            print(f'no id_bytes in the table has {peb // 1024} KiB PEBs with this layout, '
+                  f'falling back to {DEFAULT_GEOMETRY[0]}, attaching will likely fail')
+            return DEFAULT_GEOMETRY, peb, data_offset, vid_offset
+        print(f'no UBI headers found, falling back to {DEFAULT_GEOMETRY[0]}')
+    block, page = block or 64, page or 2048
+    chosen = next((entry for entry in GEOMETRIES if entry[2:4] == (block * page, page)), DEFAULT_GEOMETRY)
+    return chosen, block * page, page, None
+
+
+def inspect(image, peb, show_map=False):
+    with open(image, 'rb') as raw, mmap(raw.fileno(), 0, access=ACCESS_READ) as data:
+        start = perf_counter()
+        pebs = scan_ubi(data, peb)
+        volumes = leb_map(pebs)
+        table = volume_table(data, peb, pebs, volumes)
+        cost = perf_counter() - start
+    states = Counter(state for state, _, _ in pebs.values())
+    headers = [ec for _, ec, _ in pebs.values() if ec]
+    print(f'{len(pebs)} PEBs of {peb // 1024} KiB scanned in {cost:.2f}s: '
+          + ', '.join(f'{states[state]} {state}' for state in ('used', 'free', 'empty', 'corrupt')))
+    if not headers:
+        print('no UBI headers, wrong PEB size or not a UBI image')
+        return
+    layouts = Counter((ec[3], ec[4]) for ec in headers)
+    for (vid_offset, data_offset), count in layouts.most_common():
+        print(f'VID header offset {vid_offset}, data offset {data_offset}: {count} PEBs')
+    sequences = Counter(ec[5] for ec in headers)
+    print('image_seq ' + ', '.join(f'{seq:#x} ({count})' for seq, count in sequences.most_common()))
+    counters = [ec[2] for ec in headers]
+    print(f'erase counters min {min(counters)} max {max(counters)} mean {sum(counters) / len(counters):.1f}')
+    for vol_id in sorted(set(table) | set(volumes) - {UBI_LAYOUT_VOLUME_ID}):
+        lebs = volumes.get(vol_id, {})
+        if vol_id in table:
+            reserved, _, _, vol_type, upd_marker, name_len, name, _, _ = table[vol_id]
+            name = name[:name_len].decode(errors='replace')
+        else:
+            reserved, upd_marker, name = 0, 0, '(not in volume table)'
+            vol_type = pebs[next(iter(lebs.values()))][2][2]
+        print(f'volume {vol_id} "{name}": {VOL_TYPES.get(vol_type, vol_type)}, {len(lebs)} of {reserved} LEBs mapped'
+              + (', update interrupted' if upd_marker else ''))
+        if show_map:
+            for lnum, index in sorted(lebs.items()):
+                print(f'  LEB {lnum} -> PEB {index} (ec {pebs[index][1][2]})')
+    bad = [index for index, (state, _, _) in pebs.items() if state == 'corrupt']
+    if bad:
+        print('corrupt PEBs: ' + ' '.join(map(str, bad[:64])) + (' ...' if len(bad) > 64 else ''))
+
+
 if __name__ == '__main__':
     args = parser.parse_args()
+    chosen, erase, page, vid_offset = geometry(args.nandfile, args.block, args.page)
+    if args.inspect:
+        inspect(args.nandfile, erase, args.map)
+        raise SystemExit
+    blocks = path.getsize(args.nandfile) // erase
+    if not blocks:
+        parser.error(f'{args.nandfile} is smaller than one erase block ({erase} bytes)')
 
-    if path.exists('/dev/mtd0'):
-        check_call('sudo rmmod nandsim', shell=True)
-    blocks = path.getsize(args.nandfile) // (args.block * args.page) 
-    check_call(f'sudo modprobe nandsim id_bytes="0xec,0xa1,0x00,0x15" parts={blocks} dyndbg="+pmf"'
-               ,shell=True)
-    with open('/dev/mtd0', 'bw') as mtd, open(args.nandfile, 'rb') as raw:
-        copyfileobj(raw, mtd)
-        
-    print('Use: sudo modprobe ubi dyndbg=+pmf #load ubi')
-    print('Use: sudo ubiattach  -O 2048 -p /dev/mtd0 #attach ubi')
+    target = args.output
+    if target is None:
+        if path.exists('/dev/mtd0'):
+            check_call('sudo rmmod nandsim', shell=True)
+        # 芯片比镜像小时用overridesize按2的幂个擦除块撑大
+        override = f' overridesize={(blocks - 1).bit_length()}' if chosen[1] < blocks * erase else ''
+        check_call(f'sudo modprobe nandsim id_bytes="{chosen[0]}" parts={blocks}{override} dyndbg="+pmf"'
+                   ,shell=True)
+        target = '/dev/mtd0'
+    blocks, skipped, written, tail, cost = load(args.nandfile, target, erase, page)
+    size = blocks * erase / (1 << 20)
+    print(f'{blocks} blocks ({skipped} erased, skipped), wrote {written / (1 << 20):.1f} of {size:.1f} MiB '
+          f'in {cost:.2f}s, {size / max(cost, 1e-9):.1f} MiB/s')
+    if tail:
+        print(f'warning: {tail} bytes after the last whole erase block were not written')
+    if args.output is None:
+        print('Use: sudo modprobe ubi dyndbg=+pmf #load ubi')
+        print(f'Use: sudo ubiattach  -O {vid_offset or 2048} -p /dev/mtd0 #attach ubi')
@@ -1,23 +1,1047 @@
 from paramiko import SSHClient,RSAKey,AutoAddPolicy
+from paramiko.common import DEFAULT_WINDOW_SIZE, DEFAULT_MAX_PACKET_SIZE
 from argparse import ArgumentParser
-from os import path
+from bisect import bisect_right
+from collections import defaultdict, deque
+from contextlib import nullcontext
+from concurrent.futures import ThreadPoolExecutor
+from gzip import GzipFile
+from hashlib import sha256
+from itertools import accumulate, islice
+from os import fstat, listdir, makedirs, path, remove, replace
+from queue import Queue
+from stat import S_ISREG
+from tempfile import NamedTemporaryFile
+from threading import Event, Lock, Thread
+from time import perf_counter
+import json
+import sys
+import zlib
+
+# 远端压缩命令，按优先级排列；本地没有对应的解压模块就跳过
+COMPRESSORS = {
+	'zstd': 'zstd -1 -c',
+	'lz4': 'lz4 -1 -c',
+	'gzip': 'gzip -1 -c',
+}
+# push方向反过来：本地压缩，远端解压
+UNCOMPRESSORS = {name: f'{name} -d -c' for name in COMPRESSORS}
+# 解压都包成file对象，read(n)最多返回n字节，全0xFF的镜像也不会一下解出几百MB
+DECOMPRESSORS = {'gzip': lambda f: GzipFile(fileobj=f)}
+COMPRESSOBJS = {'gzip': lambda: zlib.compressobj(1, wbits=31)}
+try:
+	import zstandard
+	DECOMPRESSORS['zstd'] = lambda f: zstandard.ZstdDecompressor().stream_reader(f)
+	COMPRESSOBJS['zstd'] = lambda: zstandard.ZstdCompressor(level=1).compressobj()
+except ImportError:
+	pass
+try:
+	import lz4.frame
+
+	class Lz4Compressobj:
+		# LZ4FrameCompressor要先begin()，包成和zlib一样的compress/flush
+		def __init__(self):
+			self.c = lz4.frame.LZ4FrameCompressor()
+			self.header = self.c.begin()
+
+		def compress(self, data):
+			data, self.header = self.header + self.c.compress(data), b''
+			return data
+
+		def flush(self):
+			return self.header + self.c.flush()
+
+	DECOMPRESSORS['lz4'] = lambda f: lz4.frame.LZ4FrameFile(f)
+	COMPRESSOBJS['lz4'] = Lz4Compressobj
+except ImportError:
+	pass
+
+try:
+	import numpy as np
+except ImportError:
+	np = None
+
+BLOCK = 4096
+ZERO = bytes(BLOCK)
+ERASED = b'\xff' * BLOCK
 
 parser = ArgumentParser()
-parser.add_argument('host', help='Hostname or IP address')
-parser.add_argument('remote', help='chosse a remote file path')
-parser.add_argument('local', help='chosse a local file path')
+parser.add_argument('host', nargs='?', help='Hostname or IP address')
+parser.add_argument('remote', nargs='?', help='chosse a remote file path')
+parser.add_argument('local', nargs='?', help='chosse a local file path')
+parser.add_argument('-m', '--manifest', help='batch file, one "[user@]host:remote local" per line')
+parser.add_argument('--push', action='store_true', help='write local into remote with dd of= instead of pulling')
+parser.add_argument('--no-verify', action='store_true', help='skip the remote sha256 check of transferred ranges')
+parser.add_argument('--progress', action='store_true', help='show throughput, ETA and per-stream rates on stderr')
+parser.add_argument('--stall', type=float, default=5.0, help='mark a stream stalled after this many idle seconds (default: 5)')
+parser.add_argument('--metrics-json', help='write a JSON summary of the run to this file')
+parser.add_argument('--store', help='content-addressed chunk store, local becomes the image name in it')
+parser.add_argument('--reassemble', nargs=2, metavar=('NAME', 'OUTPUT'), help='rebuild an image from --store and exit')
+parser.add_argument('--compare', metavar='[USER@]HOST:REMOTE',
+					help='list the bs blocks that differ from this device, local (optional) receives only those blocks '
+						 'as <local>.a and <local>.b')
+parser.add_argument('-j', '--jobs', type=int, default=4, help='concurrent transfers in batch mode (default: 4)')
 parser.add_argument('-p', '--port', type=int, default=22, help='SSH port (default: 22)')
 parser.add_argument('-u', '--user', default='root', help='SSH username (default: root)')
 parser.add_argument('-k', '--key', help='Path to private key file')
+parser.add_argument('-n', '--streams', type=int, default=1, help='parallel dd channels (default: 1)')
+parser.add_argument('--bs', type=int, default=1 << 20, help='dd block size for ranged pulls (default: 1MiB)')
+parser.add_argument('-z', '--compress', default='auto', choices=['auto', 'none', *COMPRESSORS],
+					help='compress on the wire, auto picks the best one on the remote (default: auto)')
+parser.add_argument('-e', '--erased', action='store_true',
+					help='keep runs of 0xFF in <local>.erased instead of writing them (erased flash)')
+parser.add_argument('--expand', metavar='LOCAL', help='write the 0xFF runs of LOCAL.erased back into LOCAL and exit')
+parser.add_argument('-r', '--resume', action='store_true', help='only pull bs-sized chunks whose sha256 differs from the local file')
+parser.add_argument('--buffer', type=int, default=1 << 20, help='receive buffer, one local write per fill (default: 1MiB)')
+parser.add_argument('--window', type=int, default=DEFAULT_WINDOW_SIZE, help=f'SSH channel window (default: {DEFAULT_WINDOW_SIZE})')
+parser.add_argument('--packet', type=int, default=DEFAULT_MAX_PACKET_SIZE, help=f'SSH max packet size (default: {DEFAULT_MAX_PACKET_SIZE})')
+
+def remote_size(client, remote):
+	# 块设备stat出来是0，优先用blockdev；NAND的/dev/mtdN是字符设备，大小在sysfs里
+	_, stdout, _ = client.exec_command(f'blockdev --getsize64 {remote} 2>/dev/null || '
+									   f'{{ [ -c {remote} ] && cat /sys/class/mtd/$(basename {remote})/size; }} 2>/dev/null || '
+									   f'stat -L -c %s {remote}')
+	size = stdout.read().strip()
+	return int(size) if size.isdigit() else 0
+
+def probe_compressor(client):
+	# 真正跑一次压缩命令，busybox的gzip可能不支持-1
+	probe = '; '.join(f'echo | {cmd} >/dev/null 2>&1 && echo {name}'
+					  for name, cmd in COMPRESSORS.items() if name in DECOMPRESSORS)
+	_, stdout, _ = client.exec_command(probe)
+	found = stdout.read().decode().split()
+	return found[0] if found else None
+
+def probe_sha256(client):
+	# 精简的busybox可能没编sha256sum，不先查的话校验只会报sha256 mismatch
+	_, stdout, _ = client.exec_command('echo | sha256sum >/dev/null 2>&1 && echo ok')
+	return stdout.read().strip() == b'ok'
+
+def split_ranges(size, streams, bs):
+	blocks = (size + bs - 1) // bs
+	per = (blocks + streams - 1) // streams
+	return [(skip, min(per, blocks - skip)) for skip in range(0, blocks, max(per, 1))]
+
+class SparseWriter:
+	# 按BLOCK对齐处理：全0块跳过留成空洞，erased模式下全0xFF块只记录区间
+	def __init__(self, f, offset, holes=True, erased=False):
+		self.f = f
+		self.pos = offset
+		self.holes = holes
+		self.erased = erased
+		self.pending = b''
+		self.runs = []
+
+	def write(self, data):
+		if self.pending:
+			data = self.pending + data
+		end = len(data) - len(data) % BLOCK
+		self.pending = data[end:]
+		start = 0
+		for i in range(0, end, BLOCK):
+			block = data[i:i + BLOCK]
+			if self.holes and block == ZERO:
+				pass
+			elif self.erased and block == ERASED:
+				if self.runs and sum(self.runs[-1]) == self.pos + i:
+					self.runs[-1] = (self.runs[-1][0], self.runs[-1][1] + BLOCK)
+				else:
+					self.runs.append((self.pos + i, BLOCK))
+			else:
+				continue
+			self._flush(data, start, i)
+			start = i + BLOCK
+		self._flush(data, start, end)
+		self.pos += end
+
+	def _flush(self, data, start, end):
+		if start < end:
+			self.f.seek(self.pos + start)
+			self.f.write(memoryview(data)[start:end])
+
+	def close(self):
+		# 末尾不满一块的直接写，顺带把文件撑到正确大小
+		if self.pending:
+			self.f.seek(self.pos)
+			self.f.write(self.pending)
+			self.pos += len(self.pending)
+			self.pending = b''
+		else:
+			info = fstat(self.f.fileno())
+			if S_ISREG(info.st_mode) and info.st_size < self.pos:
+				self.f.truncate(self.pos)
+		return self.runs
+
+def resize(f, size):
+	# 只有普通文件能截断，/dev/null、块设备上truncate会EINVAL
+	regular = S_ISREG(fstat(f.fileno()).st_mode)
+	if regular:
+		f.truncate(size)
+	return regular
+
+def merge_runs(runs):
+	merged = []
+	for offset, length in sorted(runs):
+		if merged and sum(merged[-1]) >= offset:
+			merged[-1] = (merged[-1][0], max(sum(merged[-1]), offset + length) - merged[-1][0])
+		else:
+			merged.append((offset, length))
+	return merged
+
+def clip_runs(runs, start, end):
+	clipped = []
+	for offset, length in runs:
+		if offset < start:
+			clipped.append((offset, min(offset + length, start) - offset))
+		if offset + length > end:
+			clipped.append((max(offset, end), offset + length - max(offset, end)))
+	return clipped
+
+def load_erased(localfile):
+	if not path.exists(localfile + '.erased'):
+		return []
+	with open(localfile + '.erased') as f:
+		return [tuple(int(x, 16) for x in line.split()) for line in f if line.strip()]
+
+def save_erased(localfile, runs):
+	if not runs:
+		if path.exists(localfile + '.erased'):
+			remove(localfile + '.erased')
+		return
+	with open(localfile + '.erased', 'w') as f:
+		for offset, length in merge_runs(runs):
+			f.write(f'{offset:#x} {length:#x}\n')
+
+def expand_erased(localfile):
+	# 把sidecar里的0xFF区间写回，得到完整镜像
+	with open(localfile, 'r+b') as w:
+		for offset, length in load_erased(localfile):
+			w.seek(offset)
+			for i in range(0, length, 1 << 20):
+				w.write(b'\xff' * min(1 << 20, length - i))
+	save_erased(localfile, [])
+
+def tune_transport(transport, window=DEFAULT_WINDOW_SIZE, packet=DEFAULT_MAX_PACKET_SIZE):
+	# 之后open_session开的channel都用这组参数
+	transport.default_window_size = window
+	transport.default_max_packet_size = packet
+
+class Progress:
+	# 所有channel共用一个，后台线程每秒采样一次，算瞬时速度/ETA/卡住的stream
+	def __init__(self, show=True, stall=5.0, interval=1.0):
+		self.show = show
+		self.stall = stall
+		self.interval = interval
+		self.lock = Lock()
+		self.start = perf_counter()
+		self.total = 0
+		self.done = 0
+		self.peak = 0.0
+		self.streams = {}
+		self.samples = deque([(self.start, 0)], maxlen=4)
+		self.stopped = Event()
+		self.thread = Thread(target=self._run, daemon=True)
+
+	def expect(self, size):
+		with self.lock:
+			self.total += size
+
+	def begin(self, name):
+		now = perf_counter()
+		with self.lock:
+			self.streams[name] = {'bytes': 0, 'start': now, 'last': now, 'end': None, 'stall': 0.0}
+
+	def update(self, name, n):
+		now = perf_counter()
+		with self.lock:
+			stream = self.streams[name]
+			stream['stall'] = max(stream['stall'], now - stream['last'])
+			stream['last'] = now
+			stream['bytes'] += n
+			self.done += n
+
+	def end(self, name):
+		now = perf_counter()
+		with self.lock:
+			stream = self.streams[name]
+			stream['stall'] = max(stream['stall'], now - stream['last'])
+			stream['end'] = now
+
+	def line(self):
+		now = perf_counter()
+		with self.lock:
+			done, total = self.done, self.total
+			active = [(name, s) for name, s in self.streams.items() if s['end'] is None]
+		(then, before), elapsed = self.samples[0], now - self.start
+		speed = (done - before) / max(now - then, 1e-9)
+		text = f'{done / (1 << 20):.1f}'
+		if total:
+			text += f'/{total / (1 << 20):.1f} MiB {done * 100 / total:.1f}%'
+		else:
+			text += ' MiB'
+		text += f' now {speed / (1 << 20):.1f} MB/s avg {done / max(elapsed, 1e-9) / (1 << 20):.1f} MB/s'
+		if total and speed:
+			eta = int(max(total - done, 0) / speed)
+			text += f' ETA {eta // 3600}:{eta // 60 % 60:02}:{eta % 60:02}'
+		rates = [f'{s["bytes"] / max(now - s["start"], 1e-9) / (1 << 20):.1f}' + ('!' if now - s['last'] > self.stall else '')
+				 for _, s in active]
+		if rates:
+			text += f' streams [{" ".join(rates)}]'
+		return text
+
+	def _run(self):
+		while not self.stopped.wait(self.interval):
+			now = perf_counter()
+			with self.lock:
+				done = self.done
+			then, before = self.samples[-1]
+			self.peak = max(self.peak, (done - before) / max(now - then, 1e-9))
+			self.samples.append((now, done))
+			if self.show:
+				print(f'\r{self.line()}\033[K', end='', file=sys.stderr, flush=True)
+
+	def metrics(self):
+		elapsed = perf_counter() - self.start
+		with self.lock:
+			streams = [{'name': name, 'bytes': s['bytes'], 'seconds': (s['end'] or perf_counter()) - s['start'],
+						'max_stall': s['stall']} for name, s in self.streams.items()]
+		for stream in streams:
+			stream['mbps'] = stream['bytes'] / max(stream['seconds'], 1e-9) / (1 << 20)
+		return {'elapsed': elapsed, 'bytes': self.done, 'total': self.total,
+				'avg_mbps': self.done / max(elapsed, 1e-9) / (1 << 20), 'peak_mbps': self.peak / (1 << 20),
+				'streams': streams}
+
+	def __enter__(self):
+		self.thread.start()
+		return self
+
+	def __exit__(self, *exc):
+		self.stopped.set()
+		self.thread.join()
+		if self.show:
+			print(f'\r{self.line()}\033[K', file=sys.stderr)
+
+class WireReader:
+	# 给解压器当fileobj用，顺便统计线上字节数
+	def __init__(self, channel):
+		self.channel = channel
+		self.wire = 0
+
+	def read(self, size=1 << 16):
+		data = self.channel.recv(size if size > 0 else 1 << 16)
+		self.wire += len(data)
+		return data
+
+class RangeReader:
+	# 一个range一个channel，迭代出解压后的数据，每块不超过buffer
+	def __init__(self, transport, remote, bs, skip=0, count=None, compress=None, buffer=1 << 20, verify=True,
+				 progress=None):
+		self.remote = remote
+		self.progress = progress
+		self.name = f'{transport.getpeername()[0]}:{remote}@{skip}'
+		self.skip = skip
+		self.buffer = buffer
+		self.raw = 0
+		self.compress = compress
+		self.channel = transport.open_session()
+		self.cmd = dd = f'dd if={remote} bs={bs} skip={skip}' + ('' if count is None else f' count={count}')
+		if compress:
+			# 管道的退出码是压缩命令的，dd失败只能从stderr带回来；数据走fd3进压缩，
+			# dd自己的报错留下，只去掉records in/out和统计行
+			self.cmd = (f'{{ err=$({dd} 2>&1 >&3) || {{ echo "dd failed: $?"; echo "$err" | '
+						f"grep -v -e 'records in' -e 'records out' -e 'bytes.*copied'; }} >&2; }} 3>&1 | "
+						f'{COMPRESSORS[compress]}')
+		self.channel.exec_command(self.cmd)
+		self.transport = transport
+		self.dd = dd
+		self.verify = verify
+		self.wire_reader = WireReader(self.channel)
+		self.source = DECOMPRESSORS[compress](self.wire_reader) if compress else self.wire_reader
+
+	@property
+	def wire(self):
+		return self.wire_reader.wire
+
+	def __iter__(self):
+		digest = sha256()
+		if self.progress:
+			self.progress.begin(self.name)
+		while data := self.source.read(self.buffer):
+			self.raw += len(data)
+			if self.verify:
+				digest.update(data)
+			if self.progress:
+				self.progress.update(self.name, len(data))
+			yield data
+		if self.progress:
+			self.progress.end(self.name)
+		status = self.channel.recv_exit_status()
+		error = self.channel.makefile_stderr('rb').read() if status or self.compress else b''
+		if status or b'dd failed' in error:
+			# 批量模式的汇总表一行一条，多行报错拼成一行
+			message = '; '.join(line for line in error.decode(errors='replace').splitlines() if line.strip())
+			raise RuntimeError(f'{self.dd}: {message}')
+		self.channel.close()
+		if self.verify:
+			# 数据channel关了再开校验channel，和push_range一样，每个流同时只占一个session，
+			# 不会撞上sshd的MaxSessions(默认10)
+			checker = self.transport.open_session()
+			checker.exec_command(f'{self.dd} 2>/dev/null | sha256sum')
+			if checker.makefile('rb').read().split()[:1] != [digest.hexdigest().encode()]:
+				raise RuntimeError(f'{self.remote}: sha256 mismatch at block {self.skip}')
+
+def pull_range(transport, remote, localfile, bs, skip=0, count=None, compress=None, holes=True, erased=False,
+			   buffer=1 << 20, verify=True, progress=None):
+	# 直接写到本地文件对应偏移
+	reader = RangeReader(transport, remote, bs, skip, count, compress, buffer, verify, progress)
+	# paramiko只能recv出bytes，这里攒满一整块预分配的buffer再写，写盘次数按buffer算
+	buf = bytearray(buffer)
+	view = memoryview(buf)
+	fill = 0
+	with open(localfile, 'r+b') as f:
+		w = SparseWriter(f, skip * bs, holes, erased)
+		for data in reader:
+			data = memoryview(data)
+			while data:
+				n = min(len(data), buffer - fill)
+				view[fill:fill + n] = data[:n]
+				data = data[n:]
+				fill += n
+				if fill == buffer:
+					w.write(buf)
+					fill = 0
+		w.write(buf[:fill])
+		runs = w.close()
+	return reader.wire, reader.raw, runs
+
+def remote_digests(transport, remote, bs, skip, count):
+	# 一条命令算完整个range的sha256，避免每块一个channel
+	channel = transport.open_session()
+	channel.exec_command(f'i={skip}; while [ $i -lt {skip + count} ]; do '
+						 f'dd if={remote} bs={bs} skip=$i count=1 2>/dev/null | sha256sum || exit 1; i=$((i+1)); done')
+	digests = [line.split()[0].decode() for line in channel.makefile('rb').read().splitlines()]
+	# 少了的块zip的时候会被当成没变，连接断了或者循环中途退出都必须报错
+	status = channel.recv_exit_status()
+	if status or len(digests) != count:
+		raise RuntimeError(f'{remote}: got {len(digests)} of {count} block digests at block {skip} (exit {status})')
+	return digests
+
+def block_digests(client, remote, streams=1, bs=1 << 20, size=None):
+	size = remote_size(client, remote) if size is None else size
+	transport = client.get_transport()
+	with ThreadPoolExecutor(streams) as pool:
+		jobs = [pool.submit(remote_digests, transport, remote, bs, skip, count)
+				for skip, count in split_ranges(size, streams, bs)]
+		return [digest for job in jobs for digest in job.result()]
+
+def local_digests(localfile, bs, count, runs=()):
+	# runs是sidecar记录的0xFF区间，哈希前先补回去
+	starts = [offset for offset, _ in runs]
+	digests = []
+	with open(localfile, 'rb') as r:
+		while len(digests) < count and (data := r.read(bs)):
+			base = len(digests) * bs
+			i = max(bisect_right(starts, base) - 1, 0)
+			if runs and runs[i][0] < base + len(data):
+				data = bytearray(data)
+				for offset, length in runs[i:]:
+					if offset >= base + len(data):
+						break
+					start, end = max(offset - base, 0), min(offset + length - base, len(data))
+					if start < end:
+						data[start:end] = b'\xff' * (end - start)
+			digests.append(sha256(data).hexdigest())
+	return digests + [None] * (count - len(digests))
+
+def delta_ranges(remote, local):
+	ranges = []
+	for i, (a, b) in enumerate(zip(remote, local)):
+		if a == b:
+			continue
+		if ranges and sum(ranges[-1]) == i:
+			ranges[-1] = (ranges[-1][0], ranges[-1][1] + 1)
+		else:
+			ranges.append((i, 1))
+	return ranges
+
+def chop_ranges(ranges, per):
+	return [(skip + i, min(per, count - i)) for skip, count in ranges for i in range(0, count, per)]
+
+def pull(client, remote, localfile, streams=1, bs=1 << 20, resume=False, compress=None, erased=False, buffer=1 << 20,
+		 verify=True, progress=None):
+	transport = client.get_transport()
+	size = remote_size(client, remote) if streams > 1 or resume or progress else 0
+	ranges = split_ranges(size, streams, bs)
+	runs = []
+	if resume and not size:
+		# 旧的半截镜像不能被下面的'wb'截掉
+		raise RuntimeError(f'{remote}: size unknown, cannot resume')
+	if resume and path.exists(localfile):
+		with open(localfile, 'r+b') as w:
+			regular = resize(w, size)
+		runs = merge_runs(load_erased(localfile)) if regular else []
+		with ThreadPoolExecutor(streams) as pool:
+			jobs = [pool.submit(remote_digests, transport, remote, bs, skip, count) for skip, count in ranges]
+			local = local_digests(localfile, bs, sum(count for _, count in ranges), runs)
+			digests = [digest for job in jobs for digest in job.result()]
+		changed = delta_ranges(digests, local)
+		blocks = sum(count for _, count in changed)
+		print(f'resume: {blocks}/{len(local)} chunks changed')
+		# 变化的块重新按streams切，断点续传时剩下的一大段也能并行
+		ranges = chop_ranges(changed, max((blocks + streams - 1) // streams, 1))
+		for skip, count in changed:
+			runs = clip_runs(runs, skip * bs, (skip + count) * bs)
+		# 旧数据还在，全0块必须真的写下去
+		holes = False
+	else:
+		# 只有刚截断的普通文件全0块能留成空洞；设备上旧数据还在，每块都得写
+		with open(localfile, 'wb') as w:
+			holes = regular = resize(w, size)
+	# 0xFF只记进sidecar同样只对普通文件成立，设备上要真的写下去
+	erased = erased and regular
+	if not size:
+		# 大小未知(/proc之类)只能单流读到EOF
+		ranges = [(0, None)]
+		if streams > 1:
+			print(f'{remote}: size unknown, pulling with a single stream', file=sys.stderr)
+	with ThreadPoolExecutor(streams) as pool:
+		if progress:
+			progress.expect(min(sum(count for _, count in ranges) * bs, size) if size else 0)
+		jobs = [pool.submit(pull_range, transport, remote, localfile, bs, skip, count, compress, holes, erased, buffer,
+							verify, progress) for skip, count in ranges]
+		stats = [job.result() for job in jobs]
+	if regular:
+		save_erased(localfile, runs + [run for _, _, ranged in stats for run in ranged])
+	return sum(wire for wire, _, _ in stats), sum(raw for _, raw, _ in stats)
+
+def iter_stream(client, remote, streams=1, bs=1 << 20, compress=None, buffer=1 << 20, verify=True, stats=None,
+				progress=None):
+	# 按顺序吐数据；并行时最多streams个range在路上，每个range不超过8个buffer，内存有上限
+	# stats给了的话把线上字节数累加到stats['wire']
+	stats = {'wire': 0} if stats is None else stats
+	transport = client.get_transport()
+	size = remote_size(client, remote) if streams > 1 or progress else 0
+	if progress:
+		progress.expect(size)
+	if streams > 1 and not size:
+		print(f'{remote}: size unknown, pulling with a single stream', file=sys.stderr)
+	if streams == 1 or not size:
+		# 单流时消费慢了ssh窗口自然会停住远端
+		reader = RangeReader(transport, remote, bs, compress=compress, buffer=buffer, verify=verify, progress=progress)
+		yield from reader
+		stats['wire'] = stats.get('wire', 0) + reader.wire
+		return
+	ranges = iter(chop_ranges(split_ranges(size, 1, bs), max(buffer * 8 // bs, 1)))
+
+	def fetch(skip, count, queue):
+		try:
+			reader = RangeReader(transport, remote, bs, skip, count, compress, buffer, verify, progress)
+			for data in reader:
+				queue.put(data)
+			queue.put(reader)
+		except Exception as e:
+			queue.put(e)
+
+	with ThreadPoolExecutor(streams) as pool:
+		pending = deque()
+		def submit(skip, count):
+			pending.append(Queue())
+			pool.submit(fetch, skip, count, pending[-1])
+		for skip, count in islice(ranges, streams):
+			submit(skip, count)
+		while pending:
+			queue = pending.popleft()
+			while not isinstance(data := queue.get(), RangeReader):
+				if isinstance(data, Exception):
+					raise data
+				yield data
+			stats['wire'] = stats.get('wire', 0) + data.wire
+			for skip, count in islice(ranges, 1):
+				submit(skip, count)
+
+def iter_remote(host, remote, key=None, port=22, user='root', streams=1, bs=1 << 20, compress='auto',
+				buffer=1 << 20, verify=True):
+	# 给其它脚本import用：for data in iter_remote('192.168.1.10', '/dev/mtd0', '~/.ssh/id_rsa'): ...
+	if isinstance(key, str):
+		key = RSAKey.from_private_key_file(path.expanduser(key))
+	with HostPool(key, port, user, compress=compress) as pool:
+		verify = verify and pool.has_sha256(host)
+		client, compress = pool.get(host)
+		yield from iter_stream(client, remote, streams, bs, compress, buffer, verify)
+
+def push_range(transport, localfile, remote, bs, skip, length, compress=None, buffer=1 << 20, verify=True,
+			   progress=None):
+	# 不带count：管道里dd会读到短块，直接写到EOF才准
+	name = f'{transport.getpeername()[0]}:{remote}@{skip}'
+	if progress:
+		progress.begin(name)
+	channel = transport.open_session()
+	cmd = f'dd of={remote} bs={bs} seek={skip} conv=notrunc'
+	if compress:
+		cmd = f'{UNCOMPRESSORS[compress]} | {cmd}'
+	channel.exec_command(cmd)
+	encoder = COMPRESSOBJS[compress]() if compress else None
+	digest = sha256()
+	buf = bytearray(buffer)
+	view = memoryview(buf)
+	wire = raw = 0
+	try:
+		with open(localfile, 'rb') as r:
+			r.seek(skip * bs)
+			while raw < length and (n := r.readinto(view[:min(buffer, length - raw)])):
+				raw += n
+				data = view[:n]
+				digest.update(data)
+				if encoder:
+					data = encoder.compress(data)
+				wire += len(data)
+				channel.sendall(data)
+				if progress:
+					progress.update(name, n)
+		if encoder:
+			data = encoder.flush()
+			wire += len(data)
+			channel.sendall(data)
+	except OSError:
+		# 远端dd提前退出，错误信息在下面的退出码和stderr里
+		pass
+	channel.shutdown_write()
+	status = channel.recv_exit_status()
+	if status or raw < length:
+		raise RuntimeError(f'{cmd}: {channel.makefile_stderr("rb").read().decode(errors="replace").strip()}')
+	if progress:
+		progress.end(name)
+	if verify:
+		channel = transport.open_session()
+		channel.exec_command(f'sync; dd if={remote} bs={bs} skip={skip} count={(length + bs - 1) // bs} 2>/dev/null'
+							 f' | head -c {length} | sha256sum')
+		written = channel.makefile('rb').read().split()[:1]
+		if written != [digest.hexdigest().encode()]:
+			raise RuntimeError(f'{remote}: verify failed at block {skip}')
+	return wire, raw
+
+def push(client, localfile, remote, streams=1, bs=1 << 20, compress=None, buffer=1 << 20, verify=True, progress=None):
+	transport = client.get_transport()
+	size = path.getsize(localfile)
+	if progress:
+		progress.expect(size)
+	# 每个range写完马上在自己的线程里校验，和其它range的写入重叠
+	with ThreadPoolExecutor(streams) as pool:
+		jobs = [pool.submit(push_range, transport, localfile, remote, bs, skip,
+							min(count * bs, size - skip * bs), compress, buffer, verify, progress)
+				for skip, count in split_ranges(size, streams, bs)]
+		stats = [job.result() for job in jobs]
+	return sum(wire for wire, _ in stats), sum(raw for _, raw in stats)
+
+# gear hash只看掩码覆盖的低16位，等价于最近16个字节的窗口，可以用numpy整块算
+GEAR = [int.from_bytes(sha256(bytes([i])).digest()[:4], 'little') for i in range(256)]
+CDC_MIN, CDC_MASK, CDC_MAX = 16 << 10, (1 << 16) - 1, 256 << 10
+
+def cdc_cuts(buf):
+	data = np.frombuffer(buf, np.uint8)
+	gear = np.array(GEAR, np.uint32)[data]
+	h = gear.copy()
+	for k in range(1, 16):
+		h[k:] += gear[:-k] << np.uint32(k)
+	return np.flatnonzero((h & CDC_MASK) == 0) + 1
+
+def iter_chunks(stream):
+	# 内容定义分块：min/max之间按gear hash切，同样的内容在不同镜像里切出同样的块
+	pending = b''
+	for data in stream:
+		buf = pending + bytes(data)
+		start = 0
+		for end in cdc_cuts(buf).tolist():
+			while end - start > CDC_MAX:
+				yield buf[start:start + CDC_MAX]
+				start += CDC_MAX
+			if end - start >= CDC_MIN:
+				yield buf[start:end]
+				start = end
+		while len(buf) - start >= CDC_MAX:
+			yield buf[start:start + CDC_MAX]
+			start += CDC_MAX
+		pending = buf[start:]
+	if pending:
+		yield pending
+
+class ChunkStore:
+	# chunks/<2位>/<sha256> 每块只存一份，images/<name>.json 记录块列表，
+	# images/<name>.blocks 是8字节bs加上每个bs块的32字节sha256，建块索引只读这个
+	def __init__(self, root):
+		self.root = root
+		self.manifests = {}
+		makedirs(path.join(root, 'chunks'), exist_ok=True)
+		makedirs(path.join(root, 'images'), exist_ok=True)
+
+	def chunk_path(self, digest):
+		return path.join(self.root, 'chunks', digest[:2], digest)
+
+	def put(self, data):
+		digest = sha256(data).hexdigest()
+		target = self.chunk_path(digest)
+		if path.exists(target):
+			return digest, False
+		makedirs(path.dirname(target), exist_ok=True)
+		# 先写临时文件再rename，并发拉同一块也不会读到半个
+		with NamedTemporaryFile(dir=path.dirname(target), delete=False) as f:
+			f.write(data)
+		replace(f.name, target)
+		return digest, True
+
+	def get(self, digest):
+		with open(self.chunk_path(digest), 'rb') as f:
+			return f.read()
+
+	def images(self):
+		return sorted(name[:-5] for name in listdir(path.join(self.root, 'images')) if name.endswith('.json'))
+
+	def manifest(self, name):
+		if name not in self.manifests:
+			with open(path.join(self.root, 'images', name + '.json')) as f:
+				manifest = json.load(f)
+			manifest['offsets'] = list(accumulate((length for _, length in manifest['chunks']), initial=0))
+			self.manifests[name] = manifest
+		return self.manifests[name]
+
+	def write_blocks(self, name, bs, blocks):
+		with NamedTemporaryFile(dir=path.join(self.root, 'images'), delete=False) as f:
+			f.write(bs.to_bytes(8, 'little'))
+			f.write(b''.join(bytes.fromhex(digest) for digest in blocks))
+		replace(f.name, path.join(self.root, 'images', name + '.blocks'))
+
+	def blocks(self, name):
+		# 返回 (bs, 摘要bytes)；老的库块哈希还在json里，读一次补写.blocks，不进manifest缓存
+		try:
+			with open(path.join(self.root, 'images', name + '.blocks'), 'rb') as f:
+				data = f.read()
+		except FileNotFoundError:
+			with open(path.join(self.root, 'images', name + '.json')) as f:
+				manifest = json.load(f)
+			self.write_blocks(name, manifest['bs'], manifest['blocks'])
+			return manifest['bs'], b''.join(bytes.fromhex(digest) for digest in manifest['blocks'])
+		return int.from_bytes(data[:8], 'little'), data[8:]
+
+	def block_index(self, bs):
+		# 只读每个镜像的块摘要，块列表等read_range真用到那个镜像时才加载
+		index = {}
+		for name in self.images():
+			size, digests = self.blocks(name)
+			if size == bs:
+				for i in range(len(digests) // 32):
+					index.setdefault(digests[i * 32:i * 32 + 32].hex(), (name, i))
+		return index
+
+	def read_range(self, name, offset, length):
+		manifest = self.manifest(name)
+		offsets = manifest['offsets']
+		i = bisect_right(offsets, offset) - 1
+		out = bytearray()
+		while len(out) < length and i < len(manifest['chunks']):
+			data = self.get(manifest['chunks'][i][0])
+			out += data[max(offset + len(out) - offsets[i], 0):]
+			i += 1
+		return bytes(out[:length])
+
+	def ingest(self, name, stream, bs=1 << 20):
+		# 边分块边按bs算块哈希，下次拉相似的板子就能按块查到
+		if np is None:
+			raise RuntimeError('the chunk store needs numpy')
+		chunks = []
+		blocks = []
+		block = sha256()
+		fill = size = new = 0
+		for chunk in iter_chunks(stream):
+			digest, created = self.put(chunk)
+			chunks.append((digest, len(chunk)))
+			new += len(chunk) if created else 0
+			view = memoryview(chunk)
+			while view:
+				n = min(len(view), bs - fill)
+				block.update(view[:n])
+				view = view[n:]
+				fill += n
+				if fill == bs:
+					blocks.append(block.hexdigest())
+					block = sha256()
+					fill = 0
+			size += len(chunk)
+		if fill:
+			blocks.append(block.hexdigest())
+		self.write_blocks(name, bs, blocks)
+		manifest = {'size': size, 'bs': bs, 'chunks': chunks}
+		with NamedTemporaryFile('w', dir=path.join(self.root, 'images'), delete=False) as f:
+			json.dump(manifest, f)
+		replace(f.name, path.join(self.root, 'images', name + '.json'))
+		self.manifests.pop(name, None)
+		return {'size': size, 'chunks': len(chunks), 'new_bytes': new, 'blocks': blocks}
+
+	def reassemble(self, name, output):
+		manifest = self.manifest(name)
+		with open(output, 'wb') as f:
+			w = SparseWriter(f, 0, resize(f, manifest['size']))
+			for digest, _ in manifest['chunks']:
+				w.write(self.get(digest))
+			w.close()
+		return manifest['size']
+
+def pull_to_store(client, remote, store, name, streams=1, bs=1 << 20, compress=None, buffer=1 << 20, verify=True,
+				  progress=None):
+	# 库里已经有的bs块从库里拿，只拉没见过的块，拼好的流再按内容分块入库
+	transport = client.get_transport()
+	size = remote_size(client, remote)
+	index = store.block_index(bs) if size else {}
+	if not index:
+		stats = {'wire': 0}
+		result = store.ingest(name, iter_stream(client, remote, streams, bs, compress, buffer, verify, stats, progress), bs)
+		return stats['wire'], result['size'], result
+	digests = block_digests(client, remote, streams, bs, size)
+	missing = delta_ranges(digests, [digest if digest in index else None for digest in digests])
+	blocks = sum(count for _, count in missing)
+	print(f'store: {blocks}/{len(digests)} blocks not in store', file=sys.stderr)
+	with NamedTemporaryFile(dir=store.root, delete=False) as f:
+		f.truncate(size)
+	try:
+		if progress:
+			progress.expect(min(blocks * bs, size))
+		with ThreadPoolExecutor(streams) as pool:
+			jobs = [pool.submit(pull_range, transport, remote, f.name, bs, skip, count, compress, True, False, buffer,
+								verify, progress)
+					for skip, count in chop_ranges(missing, max((blocks + streams - 1) // streams, 1))]
+			wire = sum(job.result()[0] for job in jobs)
+
+		def assembled():
+			with open(f.name, 'rb') as r:
+				for i, digest in enumerate(digests):
+					length = min(bs, size - i * bs)
+					if digest in index:
+						source, j = index[digest]
+						yield store.read_range(source, j * bs, length)
+					else:
+						r.seek(i * bs)
+						yield r.read(length)
+
+		result = store.ingest(name, assembled(), bs)
+	finally:
+		remove(f.name)
+	if result['blocks'] != digests:
+		raise RuntimeError(f'{remote}: assembled image does not match the remote block digests')
+	return wire, result['size'], result
+
+class HostPool:
+	# 私钥只解析一次，每个host一条连接，压缩方式和sha256sum也只探测一次
+	def __init__(self, key, port=22, user='root', window=DEFAULT_WINDOW_SIZE, packet=DEFAULT_MAX_PACKET_SIZE,
+				 compress='auto'):
+		self.key = key
+		self.port = port
+		self.user = user
+		self.window = window
+		self.packet = packet
+		self.compress = compress
+		self.clients = {}
+		self.sha256 = {}
+		self.locks = defaultdict(Lock)
+		self.lock = Lock()
+
+	def get(self, host):
+		with self.lock:
+			lock = self.locks[host]
+		with lock:
+			if host not in self.clients:
+				user, _, hostname = host.rpartition('@')
+				client = SSHClient()
+				client.set_missing_host_key_policy(AutoAddPolicy())
+				client.connect(hostname, port=self.port, username=user or self.user, pkey=self.key)
+				tune_transport(client.get_transport(), self.window, self.packet)
+				compress = probe_compressor(client) if self.compress == 'auto' else self.compress
+				self.clients[host] = client, None if compress == 'none' else compress
+			return self.clients[host]
+
+	def has_sha256(self, host):
+		# 每个host只探测一次，没有的话提示一次，普通拉取照常进行只是不校验
+		client, _ = self.get(host)
+		with self.locks[host]:
+			if host not in self.sha256:
+				self.sha256[host] = probe_sha256(client)
+				if not self.sha256[host]:
+					print(f'warning: {host} has no sha256sum, transfers are not verified', file=sys.stderr)
+		return self.sha256[host]
+
+	def require_sha256(self, host):
+		# 续传、比对、入库离不开远端的块摘要
+		if not self.has_sha256(host):
+			raise RuntimeError(f'{host}: sha256sum not found on the remote, needed by --resume/--store/--compare')
+
+	def __enter__(self):
+		return self
+
+	def __exit__(self, *exc):
+		for client, _ in self.clients.values():
+			client.close()
+
+def compare(pool, a, b, streams=1, bs=1 << 20):
+	# 两边同时在远端按块算sha256，只传摘要回来比，返回不同的块区间
+	def digests(source):
+		pool.require_sha256(source[0])
+		client, _ = pool.get(source[0])
+		size = remote_size(client, source[1])
+		if not size:
+			raise RuntimeError(f'{source[0]}:{source[1]}: size unknown, cannot compare')
+		return size, block_digests(client, source[1], streams, bs, size)
+	with ThreadPoolExecutor(2) as executor:
+		(size_a, digests_a), (size_b, digests_b) = executor.map(digests, (a, b))
+	blocks = max(len(digests_a), len(digests_b))
+	digests_a += [None] * (blocks - len(digests_a))
+	digests_b += [''] * (blocks - len(digests_b))
+	return size_a, size_b, delta_ranges(digests_a, digests_b)
+
+def fetch_ranges(pool, host, remote, localfile, ranges, size, streams=1, bs=1 << 20, verify=True):
+	# 只把不同的区间拉下来，其余部分留成空洞
+	verify = verify and pool.has_sha256(host)
+	client, compress = pool.get(host)
+	transport = client.get_transport()
+	with open(localfile, 'wb') as w:
+		holes = resize(w, size)
+	with ThreadPoolExecutor(streams) as executor:
+		jobs = [executor.submit(pull_range, transport, remote, localfile, bs, skip, count, compress, holes,
+								verify=verify)
+				for skip, count in ranges if skip * bs < size]
+		return sum(job.result()[1] for job in jobs)
+
+def split_source(source):
+	host, remote = source.split(':', 1)
+	return host, remote
+
+def parse_manifest(manifest):
+	entries = []
+	with open(manifest) as f:
+		for line in f:
+			line = line.split('#')[0].strip()
+			if not line:
+				continue
+			source, local = line.rsplit(None, 1)
+			entries.append((*split_source(source), local))
+	return entries
+
+def local_path(remote, local):
+	return path.join(local, path.basename(remote)) if path.isdir(local) else local
+
+def transfer(pool, host, remote, local, to_remote=False, store=None, **kwargs):
+	if kwargs.get('resume') or store:
+		pool.require_sha256(host)
+	if kwargs['verify'] and not pool.has_sha256(host):
+		kwargs = {**kwargs, 'verify': False}
+	client, compress = pool.get(host)
+	start = perf_counter()
+	if store:
+		# local是库里的镜像名
+		localfile = local
+		wire, raw, _ = pull_to_store(client, remote, store, local, kwargs['streams'], kwargs['bs'], compress,
+									 kwargs['buffer'], kwargs['verify'], kwargs.get('progress'))
+	elif to_remote:
+		localfile = local
+		wire, raw = push(client, localfile, remote, compress=compress, **kwargs)
+	elif local == '-':
+		localfile = local
+		stats = {'wire': 0}
+		raw = 0
+		for data in iter_stream(client, remote, kwargs['streams'], kwargs['bs'], compress, kwargs['buffer'],
+								kwargs['verify'], stats, kwargs.get('progress')):
+			raw += len(data)
+			sys.stdout.buffer.write(data)
+		sys.stdout.buffer.flush()
+		wire = stats['wire']
+	else:
+		localfile = local_path(remote, local)
+		wire, raw = pull(client, remote, localfile, compress=compress, **kwargs)
+	return {'host': host, 'remote': remote, 'local': localfile, 'compress': compress or 'raw',
+			'raw': raw, 'wire': wire, 'seconds': perf_counter() - start, 'error': ''}
+
+def run_batch(pool, entries, jobs=4, **kwargs):
+	def one(entry):
+		try:
+			return transfer(pool, *entry, **kwargs)
+		except Exception as e:
+			host, remote, local = entry
+			return {'host': host, 'remote': remote, 'local': local, 'compress': '-',
+					'raw': 0, 'wire': 0, 'seconds': 0, 'error': str(e) or type(e).__name__}
+	with ThreadPoolExecutor(jobs) as executor:
+		return list(executor.map(one, entries))
+
+def print_summary(rows):
+	header = ('host', 'remote', 'local', 'compress', 'bytes', 'ratio', 'MB/s', 'status')
+	table = [header]
+	for row in rows:
+		table.append((row['host'], row['remote'], row['local'], row['compress'], str(row['raw']),
+					  f'{row["raw"] / max(row["wire"], 1):.2f}',
+					  f'{row["raw"] / max(row["seconds"], 1e-9) / (1 << 20):.1f}', row['error'] or 'ok'))
+	widths = [max(len(line[i]) for line in table) for i in range(len(header))]
+	for line in table:
+		print('  '.join(cell.ljust(width) for cell, width in zip(line, widths)).rstrip())
 
 if __name__ == '__main__':
 	args = parser.parse_args()
+	if args.expand:
+		expand_erased(args.expand)
+		exit(0)
+	if args.reassemble:
+		if not args.store:
+			parser.error('--reassemble needs --store')
+		start = perf_counter()
+		size = ChunkStore(args.store).reassemble(*args.reassemble)
+		print(f'{args.reassemble[1]}: {size} bytes, {size / (perf_counter() - start) / (1 << 20):.1f} MB/s')
+		exit(0)
+	if args.compare:
+		if not (args.host and args.remote):
+			parser.error('--compare needs host and remote')
+		private_key = RSAKey.from_private_key_file(args.key)
+		a, b = (args.host, args.remote), split_source(args.compare)
+		with HostPool(private_key, args.port, args.user, args.window, args.packet, args.compress) as pool:
+			size_a, size_b, ranges = compare(pool, a, b, args.streams, args.bs)
+			for skip, count in ranges:
+				print(f'{skip * args.bs:#x} {count * args.bs:#x}')
+			differ = sum(min(count * args.bs, max(size_a, size_b) - skip * args.bs) for skip, count in ranges)
+			print(f'{len(ranges)} ranges, {differ} of {max(size_a, size_b)} bytes differ', file=sys.stderr)
+			if args.local and ranges:
+				for side, (host, remote), size in (('a', a, size_a), ('b', b, size_b)):
+					fetch_ranges(pool, host, remote, f'{args.local}.{side}', ranges, size, args.streams, args.bs,
+								 not args.no_verify)
+		exit(1 if ranges else 0)
+	if not args.manifest and not (args.host and args.remote and args.local):
+		parser.error('host, remote and local are required without --manifest')
+	if args.store and args.push:
+		parser.error('--store only works for pulls')
+	if args.erased and (args.push or args.store or args.local == '-'):
+		parser.error('-e/--erased only works when pulling into a local file')
+	if args.compress not in ('auto', 'none', *DECOMPRESSORS):
+		parser.error(f'no local decompressor for {args.compress}, install the python module')
 	private_key = RSAKey.from_private_key_file(args.key)
-	with SSHClient() as client:
-		client.set_missing_host_key_policy(AutoAddPolicy())
-		client.connect(args.host, port=args.port, username=args.user, pkey=private_key)
-		stdin, stdout, stderr = client.exec_command(f'dd if={args.remote}')
-		localfile = path.join(args.local, path.basename(args.remote)) if path.isdir(args.local) else args.local
-		with open(localfile,  'wb') as w:
-			while data := stdout.read(4096):
-				w.write(data)
\ No newline at end of file
+	if args.push:
+		options = {'to_remote': True, 'streams': args.streams, 'bs': args.bs, 'buffer': args.buffer,
+				   'verify': not args.no_verify}
+	else:
+		options = {'streams': args.streams, 'bs': args.bs, 'resume': args.resume, 'erased': args.erased,
+				   'buffer': args.buffer, 'verify': not args.no_verify}
+	if args.store:
+		options['store'] = ChunkStore(args.store)
+	progress = Progress(args.progress, args.stall) if args.progress or args.metrics_json else None
+	if progress:
+		options['progress'] = progress
+	with HostPool(private_key, args.port, args.user, args.window, args.packet, args.compress) as pool, \
+		 progress or nullcontext():
+		if args.manifest:
+			rows = run_batch(pool, parse_manifest(args.manifest), args.jobs, **options)
+		else:
+			rows = [transfer(pool, args.host, args.remote, args.local, **options)]
+	if args.metrics_json:
+		with open(args.metrics_json, 'w') as f:
+			json.dump({**progress.metrics(), 'transfers': rows}, f, indent=2)
+	if args.manifest:
+		print_summary(rows)
+		exit(1 if any(row['error'] for row in rows) else 0)
+	row = rows[0]
+	# 输出到stdout时统计信息只能走stderr
+	print(f'{row["compress"]}: {row["raw"]} bytes in {row["wire"]} on the wire, '
+		  f'ratio {row["raw"] / max(row["wire"], 1):.2f}, '
+		  f'{row["raw"] / row["seconds"] / (1 << 20):.1f} MB/s effective',
+		  file=sys.stderr if args.local == '-' else sys.stdout)
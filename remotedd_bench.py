@@ -0,0 +1,102 @@
+# remotedd.py 的吞吐测试，用本地paramiko server代替开发板
+# 命令在本机 sh -c 执行，所以测的是ssh通道本身的开销
+# python remotedd_bench.py -n 1 2 4 8                          # 并发channel数
+# python remotedd_bench.py -n 1 -b 4096 65536 1048576 4194304  # 接收buffer大小
+import socket
+from argparse import ArgumentParser
+from os import path, urandom
+from subprocess import Popen, PIPE
+from tempfile import TemporaryDirectory
+from threading import Thread
+from time import perf_counter
+from paramiko import AUTH_SUCCESSFUL, OPEN_SUCCEEDED, RSAKey, ServerInterface, SSHClient, AutoAddPolicy, Transport
+
+import remotedd
+
+parser = ArgumentParser()
+parser.add_argument('-s', '--size', type=int, default=256, help='image size in MiB (default: 256)')
+parser.add_argument('-z', '--compress', choices=list(remotedd.DECOMPRESSORS), help='compress on the wire')
+parser.add_argument('-e', '--erased', type=int, default=0, help='percent of the image filled with 0xFF (default: 0)')
+parser.add_argument('-n', '--streams', type=int, nargs='+', default=[1, 2, 4, 8], help='stream counts to test')
+parser.add_argument('-b', '--buffers', type=int, nargs='+', default=[1 << 20], help='receive buffer sizes to test')
+parser.add_argument('--no-verify', action='store_true', help='skip the sha256 check')
+parser.add_argument('--window', type=int, default=remotedd.DEFAULT_WINDOW_SIZE, help='SSH channel window')
+parser.add_argument('--packet', type=int, default=remotedd.DEFAULT_MAX_PACKET_SIZE, help='SSH max packet size')
+
+
+class LocalServer(ServerInterface):
+	def check_auth_publickey(self, username, key):
+		return AUTH_SUCCESSFUL
+
+	def get_allowed_auths(self, username):
+		return 'publickey'
+
+	def check_channel_request(self, kind, chanid):
+		return OPEN_SUCCEEDED
+
+	def check_channel_exec_request(self, channel, command):
+		Thread(target=self._exec, args=(channel, command), daemon=True).start()
+		return True
+
+	def _exec(self, channel, command):
+		proc = Popen(['sh', '-c', command], stdin=PIPE, stdout=PIPE, stderr=PIPE)
+		def feed():
+			while data := channel.recv(1 << 16):
+				proc.stdin.write(data)
+			proc.stdin.close()
+		Thread(target=feed, daemon=True).start()
+		while data := proc.stdout.read1(1 << 16):
+			channel.sendall(data)
+		channel.sendall_stderr(proc.stderr.read())
+		channel.send_exit_status(proc.wait())
+		channel.close()
+
+
+def serve(host_key, transports):
+	sock = socket.socket()
+	sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+	sock.bind(('127.0.0.1', 0))
+	sock.listen()
+	def accept():
+		while True:
+			conn, _ = sock.accept()
+			t = Transport(conn)
+			t.add_server_key(host_key)
+			t.start_server(server=LocalServer())
+			transports.append(t)
+	Thread(target=accept, daemon=True).start()
+	return sock.getsockname()[1]
+
+
+def connect(port, key):
+	client = SSHClient()
+	client.set_missing_host_key_policy(AutoAddPolicy())
+	client.connect('127.0.0.1', port=port, username='root', pkey=key, look_for_keys=False, allow_agent=False)
+	return client
+
+
+def timeit(func, *args, **kwargs):
+	start = perf_counter()
+	func(*args, **kwargs)
+	return perf_counter() - start
+
+
+if __name__ == '__main__':
+	args = parser.parse_args()
+	port = serve(RSAKey.generate(2048), [])
+	key = RSAKey.generate(2048)
+	with TemporaryDirectory() as tmp:
+		image = path.join(tmp, 'image.bin')
+		with open(image, 'wb') as f:
+			for i in range(args.size):
+				f.write(b'\xff' * (1 << 20) if i * 100 < args.erased * args.size else urandom(1 << 20))
+		local = path.join(tmp, 'pulled.bin')
+		for streams in args.streams:
+			for buffer in args.buffers:
+				with connect(port, key) as client:
+					remotedd.tune_transport(client.get_transport(), args.window, args.packet)
+					cost = timeit(remotedd.pull, client, image, local, streams, compress=args.compress, buffer=buffer,
+								  verify=not args.no_verify)
+				with open(image, 'rb') as a, open(local, 'rb') as b:
+					ok = a.read() == b.read()
+				print(f'streams={streams:<3} buffer={buffer:<8} {args.size / cost:8.1f} MB/s {"ok" if ok else "MISMATCH"}')